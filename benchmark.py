@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# Headless benchmark of every block and of the full chain.
+#
+#   ./benchmark.py --save baseline.json             # Record a baseline
+#   ./benchmark.py --compare baseline.json          # Fails if anything got slower than the threshold
+#   ./benchmark.py --only 'tx_filter|chain' --quick
+#   ./benchmark.py --validate-dtype --dtype float32 # Compares BER curves against float64
+
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+
+import sources, encoder, filter_tx, channels_frequency, channels_noise, filter_rx, sampler, decoder
+import pulses, signaling
+
+from system_simulator import SystemSimulator, Block, BufferArena
+
+
+def build_system(sps=64, n_bits=1000, pulse='Rectangular NRZ', signaling_scheme='Polar (Antipodal)',
+                 channel=0, noise=1, rx_filter=1, dtype=np.float64, workers=1):
+    blocks = [
+        Block(sources, 'D', 'source'),
+        Block(encoder, 'D', 'encoder'),
+        Block(filter_tx, 'C', 'tx_filter'),
+        Block(channels_frequency, 'C', 'channel'),
+        Block(channels_noise, 'C', 'noise'),
+        Block(filter_rx, 'C', 'rx_filter'),
+        Block(sampler, 'D', 'sampler'),
+        Block(decoder, 'D', 'decoder'),
+    ]
+    system = SystemSimulator(blocks)
+    system.sps = sps
+    system.dtype = dtype
+    system.workers = workers
+
+    for (role, idx) in [('channel', channel), ('noise', noise), ('rx_filter', rx_filter)]:
+        system.select(system.index[role], idx)
+
+    system.box('source').n_bits = n_bits
+    system.box('encoder').signaling = signaling.collection[signaling_scheme]
+    system.box('tx_filter').pulse = system.box('tx_filter').pulses[pulse]
+
+    return system
+
+
+def measure(fn, min_time=0.2, min_repeat=3, max_repeat=100):
+    # Best and median time per call
+    times = []
+    while len(times) < min_repeat or (sum(times) < min_time and len(times) < max_repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+def block_benchmarks(sps_list, n_bits_list):
+    # (name, params, build_system kwargs, block role)
+    for n_bits in n_bits_list:
+        yield 'source', {'n_bits': n_bits}, {'n_bits': n_bits}, 'source'
+        for name in signaling.collection:
+            kwargs = {'n_bits': n_bits, 'signaling_scheme': name}
+            yield 'encoder', kwargs, kwargs, 'encoder'
+            yield 'sampler', kwargs, kwargs, 'sampler'
+            yield 'decoder', kwargs, kwargs, 'decoder'
+        for sps in sps_list:
+            for name in pulses.collection:
+                kwargs = {'sps': sps, 'n_bits': n_bits, 'pulse': name}
+                yield 'tx_filter', kwargs, kwargs, 'tx_filter'
+                for idx in range(len(filter_rx.choices)):
+                    yield 'rx_filter', dict(kwargs, rx_filter=idx), dict(kwargs, rx_filter=idx), 'rx_filter'
+            for idx in range(len(channels_frequency.choices)):
+                kwargs = {'sps': sps, 'n_bits': n_bits, 'channel': idx}
+                yield 'channel_frequency', kwargs, kwargs, 'channel'
+            for idx in range(len(channels_noise.choices)):
+                kwargs = {'sps': sps, 'n_bits': n_bits, 'noise': idx}
+                yield 'channel_noise', kwargs, kwargs, 'noise'
+
+
+def chain_benchmarks(sps_list, n_bits_list):
+    for (n_bits, sps, name, idx) in itertools.product(n_bits_list, sps_list, pulses.collection,
+                                                      range(len(channels_frequency.choices))):
+        yield 'chain', {'sps': sps, 'n_bits': n_bits, 'pulse': name, 'channel': idx}
+    for (n_bits, sps) in itertools.product(n_bits_list, sps_list):
+        yield 'spectra', {'sps': sps, 'n_bits': n_bits}
+
+
+def benchmark_key(name, params):
+    return name + '[' + ','.join('{}={}'.format(k, v) for (k, v) in sorted(params.items())) + ']'
+
+
+def run(args):
+    results = {}
+
+    def report(key, best, median):
+        results[key] = {'best': best, 'median': median}
+        print('{:<100} {:>10.3f} ms {:>10.3f} ms'.format(key, 1e3 * best, 1e3 * median), flush=True)
+
+    for (name, params, kwargs, role) in block_benchmarks(args.sps, args.n_bits):
+        key = benchmark_key(name, params)
+        if not re.search(args.only, key):
+            continue
+        system = build_system(dtype=args.dtype, workers=args.workers, **kwargs)
+        system.process()
+        idx = system.index[role]
+        box = system.blocks[idx].box
+        if role == 'source':
+            fn = box.process
+        elif args.arena and getattr(box, 'out_shape', None) is not None:
+            x = system.data_t[idx - 1]
+            out = np.empty(box.out_shape(x), system.dtype)
+            fn = lambda: box.process(x, out=out)
+        else:
+            x = system.data_t[idx - 1]
+            fn = lambda: box.process(x)
+        report(key, *measure(lambda: (system.rng.seed(system.seed), fn()), args.min_time))
+
+    for (name, params) in chain_benchmarks(args.sps, args.n_bits):
+        key = benchmark_key(name, params)
+        if not re.search(args.only, key):
+            continue
+        system = build_system(dtype=args.dtype, workers=args.workers, **params)
+        if args.arena:
+            system.arena = BufferArena()
+        system.process()
+        if name == 'chain':
+            fn = system._processData
+        else:
+            fn = system._processSpectra
+        report(key, *measure(fn, args.min_time))
+
+    return results
+
+
+def validate_dtype(args):
+    # BER versus SNR in the given precision and in float64, with the same bits and noise. The curves
+    # agree if every difference is within three standard deviations of the BER estimate.
+    n_bits = max(args.n_bits)
+    ok = True
+    print('{:<50} {:>8} {:>12} {:>12}'.format('configuration', 'SNR [dB]', 'float64', args.dtype.__name__))
+    for (pulse, channel, snr_db) in itertools.product(['Rectangular NRZ', 'Raised-cosine'],
+                                                      range(len(channels_frequency.choices)), range(0, 13, 2)):
+        ber = []
+        for dtype in [np.float64, args.dtype]:
+            system = build_system(sps=min(args.sps), n_bits=n_bits, pulse=pulse, channel=channel, dtype=dtype)
+            system.retention = 'none'
+            system.box('noise').snr_db = snr_db
+            system.process()
+            ber.append(system.ber)
+        tolerance = 3 * np.sqrt(ber[0] * (1 - ber[0]) / n_bits) + 1 / n_bits
+        ok &= abs(ber[1] - ber[0]) <= tolerance
+        print('{:<50} {:>8} {:>12.3e} {:>12.3e}{}'.format('{}, channel {}'.format(pulse, channel), snr_db, ber[0], ber[1],
+                                                       '' if abs(ber[1] - ber[0]) <= tolerance else '  MISMATCH'))
+    return ok
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for (key, result) in results.items():
+        if key not in baseline:
+            continue
+        ratio = result['best'] / baseline[key]['best']
+        if ratio > 1.0 + threshold:
+            regressions.append((key, ratio))
+    for (key, ratio) in regressions:
+        print('REGRESSION {:<100} {:.2f}x slower'.format(key, ratio))
+    print('{} benchmarks compared, {} regressions (threshold {:.0%})'.format(
+        sum(key in baseline for key in results), len(regressions), threshold))
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NyqLab benchmark suite.')
+    parser.add_argument('--sps', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('--n-bits', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--quick', action='store_true', help='single small configuration')
+    parser.add_argument('--only', default='', help='regular expression selecting benchmarks')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'], help='waveform precision')
+    parser.add_argument('--validate-dtype', action='store_true', help='compare BER curves against float64')
+    parser.add_argument('--arena', action='store_true', help='reuse output buffers across runs')
+    parser.add_argument('--workers', type=int, default=1, help='threads for the transforms and spectra')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum time spent per benchmark [s]')
+    parser.add_argument('--save', metavar='PATH', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare against a stored baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown relative to the baseline')
+    args = parser.parse_args()
+
+    args.dtype = np.dtype(args.dtype).type
+    if args.quick:
+        args.sps, args.n_bits = [16], [1000]
+
+    if args.validate_dtype:
+        sys.exit(0 if validate_dtype(args) else 1)
+
+    results = run(args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
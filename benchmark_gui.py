@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Input-to-repaint latency of the GUI, measured offscreen.
+#
+#   ./benchmark_gui.py --save gui_baseline.json
+#   ./benchmark_gui.py --compare gui_baseline.json   # Fails if a p90 latency got slower than the threshold
+
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+
+from PyQt5 import QtCore, QtWidgets
+
+import pulses
+
+from nyqlab import MainWindow
+
+
+class LatencyProbe:
+    def __init__(self, app, main_window, timeout=30.0):
+        self.app = app
+        self.main_window = main_window
+        self.timeout = timeout
+        self.pending = set()
+        self.windows = {
+            'scope': main_window.window_scope,
+            'pulse': main_window.window_pulse,
+        }
+        for (name, window) in self.windows.items():
+            window.drawn.connect(lambda name=name: self.pending.discard(name))
+
+    def measure(self, action, windows):
+        # Time from the input until every window in `windows` has repainted with the new data
+        self.settle()
+        self.pending = set(windows)
+        start = time.perf_counter()
+        action()
+        deadline = start + self.timeout
+        while self.pending or self.main_window.isComputing():
+            if time.perf_counter() > deadline:
+                raise RuntimeError('timed out waiting for {}'.format(', '.join(sorted(self.pending))))
+            self.app.processEvents(QtCore.QEventLoop.AllEvents, 1)
+        self.app.processEvents()  # Flush the paint events posted by the last draw
+        return time.perf_counter() - start
+
+    def settle(self):
+        while self.main_window.isComputing():
+            self.app.processEvents(QtCore.QEventLoop.AllEvents, 1)
+        self.app.processEvents()
+
+
+def scenarios(app, main_window, args):
+    snr_slider = main_window.block_choices[4][1].snr_db_slider
+    tx_widget = main_window.block_choices[2][0]
+    pulse_names = list(pulses.collection.keys())
+    rng = np.random.RandomState(0)
+
+    def move_snr():
+        # Any value but the current one, which would not emit valueChanged and so not start a simulation
+        value = rng.randint(snr_slider.minimum(), snr_slider.maximum())
+        snr_slider.setValue(value + 1 if value >= snr_slider.value() else value)
+
+    def drag_snr():
+        # Several slider steps in quick succession; coalesced into a single simulation
+        value = snr_slider.value()
+        for i in range(args.drag_steps):
+            value = value + 1 if value < snr_slider.maximum() else snr_slider.minimum()
+            snr_slider.setValue(value)
+            app.processEvents()
+
+    def change_pulse():
+        idx = (tx_widget.pulses_combo.currentIndex() + 1) % len(pulse_names)
+        tx_widget.pulses_combo.setCurrentIndex(idx)
+        tx_widget.onChangePulse(pulse_names[idx])
+
+    return [
+        ('snr_slider', move_snr, ['scope']),
+        ('snr_slider_drag', drag_snr, ['scope']),
+        ('pulse_combo', change_pulse, ['scope', 'pulse']),
+    ]
+
+
+def percentiles(latencies):
+    latencies = 1e3 * np.asarray(latencies)
+    return {
+        'p50': float(np.percentile(latencies, 50)),
+        'p90': float(np.percentile(latencies, 90)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(np.max(latencies)),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for (name, result) in results.items():
+        if name in baseline and result['p90'] > (1.0 + threshold) * baseline[name]['p90']:
+            regressions.append((name, result['p90'], baseline[name]['p90']))
+    for (name, value, reference) in regressions:
+        print('REGRESSION {:<20} p90 {:.1f} ms (baseline {:.1f} ms)'.format(name, value, reference))
+    print('{} scenarios compared, {} regressions (threshold {:.0%})'.format(
+        sum(name in baseline for name in results), len(regressions), threshold))
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NyqLab GUI latency benchmark.')
+    parser.add_argument('--repeat', type=int, default=30, help='interactions per scenario')
+    parser.add_argument('--drag-steps', type=int, default=10, help='slider steps per drag')
+    parser.add_argument('--n-bits', type=int, help='number of bits of the source')
+    parser.add_argument('--save', metavar='PATH', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare against a stored baseline')
+    parser.add_argument('--threshold', type=float, default=0.5, help='allowed p90 slowdown relative to the baseline')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv)
+    main_window = MainWindow()
+    main_window.show()
+    main_window.showWindowScope()
+    main_window.showWindowPulse()
+
+    if args.n_bits is not None:
+        main_window.system.box('source').n_bits = args.n_bits
+    main_window.onBlockComboActivated(4, 1)  # AWGN
+
+    probe = LatencyProbe(app, main_window)
+    results = {}
+    print('{:<20} {:>10} {:>10} {:>10} {:>10}'.format('scenario', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]'))
+    for (name, action, windows) in scenarios(app, main_window, args):
+        latencies = [probe.measure(action, windows) for _ in range(args.repeat)]
+        results[name] = percentiles(latencies)
+        print('{:<20} {p50:>10.1f} {p90:>10.1f} {p99:>10.1f} {max:>10.1f}'.format(name, **results[name]), flush=True)
+
+    main_window.close()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,85 @@
 import numpy as np
+import scipy.fft
 
 from PyQt5 import QtCore, QtWidgets
 
 
+def fold(r, n, out=None):
+    # Circular filtering over n samples from the linear one: sample k is the sum of r[k + j*n]
+    if out is None:
+        out = np.empty(n, r.dtype)
+    out[:] = r[:n]
+    for j in range(n, len(r), n):
+        piece = r[j : j + n]
+        out[:len(piece)] += piece
+    return out
+
+
 class ChannelFrequency:
     ax_f_lim = [-6.0, 6.0, -0.25, 1.25]
     ax_t_lim = [-2.0, 2.0, -2.0, 6.0]
+    _padded_key = None
+    pair_chunk = 2**13  # Bins combined at a time by _filterPairs()
+
+    def response(self, n):
+        # Frequency response on the rfft grid of n samples. The output is real, so only the Hermitian part of
+        # the response acts on the signal.
+        fs = self.system.samp_freq
+        f = np.fft.rfftfreq(n, 1 / fs)
+        H = 0.5 * (self.frequency_response(f) + np.conj(self.frequency_response(-f)))
+        if n % 2 == 0:
+            H[-1] = np.real(self.frequency_response(-f[-1:]))  # Only -fs/2 is on the grid
+        return H
+
+    def padded_response(self, n, n_fft):
+        # One period of the impulse response of the circular filtering over n samples, on the rfft grid of
+        # n_fft >= 2n samples: filtering linearly with it and folding the result gives the same samples.
+        # Cached per length, sampling rate and parameters.
+        workers = self.system.workers
+        dtype = self.system.complex_dtype
+        key = (n, n_fft, self.system.samp_freq, dtype) + tuple(sorted((k, v) for (k, v) in vars(self).items() if isinstance(v, (int, float))))
+        if key != self._padded_key:
+            h = scipy.fft.irfft(self.response(n), n, workers=workers)
+            self._padded, self._padded_key = scipy.fft.rfft(h, n_fft, workers=workers).astype(dtype), key
+        return self._padded
+
+    def out_shape(self, s):
+        return s.shape
+
+    def process(self, s, out=None):
+        # Circular filtering over the record (periodic frequency response), as linear filtering folded back
+        # onto the record. The record length rarely factors well, the padded length 2m can be chosen to. The
+        # padded record is transformed in place, as m complex samples (even samples as the real part, odd
+        # ones as the imaginary part), which avoids the copies of rfft() and irfft().
+        workers = self.system.workers
+        n = len(s)
+        m = scipy.fft.next_fast_len(n)
+        w = np.zeros(2 * m, s.dtype)
+        w[:n] = s
+        Z = scipy.fft.fft(w.view(np.result_type(s.dtype, np.complex64)), overwrite_x=True, workers=workers)
+        self._filterPairs(Z, self.padded_response(n, 2 * m))
+        w = scipy.fft.ifft(Z, overwrite_x=True, workers=workers).view(s.dtype)
+        return fold(w, n, out)
+
+    def _filterPairs(self, Z, G):
+        # Z: transform of 2m real samples as m complex ones; G: response on the rfft grid of 2m samples.
+        # Filters Z in place: bins k and m - k of the filtered transform are
+        #   (s - d sin) Z[k] + i d cos conj(Z[m - k])  and  conj(s + d sin) Z[m - k] - conj(i d cos) conj(Z[k])
+        # for s, d = (G[k] +- conj(G[m - k])) / 2 and the sine and cosine of pi k / m
+        m = len(Z)
+        s, d = 0.5 * (G[0] + np.conj(G[m])), 0.5 * (G[0] - np.conj(G[m]))
+        Z[0] = s * Z[0] + 1j * d * np.conj(Z[0])
+        rotation = np.exp(1j * np.pi / m * np.arange(min(self.pair_chunk, m))).astype(G.dtype)
+        for k0 in range(1, m//2 + 1, self.pair_chunk):
+            k1 = min(k0 + self.pair_chunk, m//2 + 1)
+            lo, hi = Z[k0:k1], Z[m - k0 : m - k1 : -1]
+            e = rotation[: k1 - k0] * np.exp(1j * np.pi * k0 / m)
+            g = np.conj(G[m - k0 : m - k1 : -1])
+            s, d = 0.5 * (G[k0:k1] + g), 0.5 * (G[k0:k1] - g)
+            d_sin, d_cos = d * e.imag, 1j * d * e.real
+            filtered = (s - d_sin) * lo + d_cos * np.conj(hi)
+            hi[:] = np.conj(s + d_sin) * hi - np.conj(d_cos) * np.conj(lo)
+            lo[:] = filtered
 
     def widget(self):
         try:
@@ -26,7 +100,9 @@ class ChannelFrequency_Widget(QtWidgets.QWidget):
 # Ideal channel
 
 class Bypass_ChannelFrequency(ChannelFrequency):
-    def process(self, s):
+    out_shape = None
+
+    def process(self, s, out=None):
         return s
 
 
@@ -36,17 +112,9 @@ class IdealLowpass_ChannelFrequency(ChannelFrequency):
     def __init__(self, bandwidth=2.0):
         self.bandwidth = bandwidth
 
-    def process(self, s):
-        fs = self.system.samp_freq
-        Ns = len(s)
-        f = np.arange(-Ns//2, Ns//2) * (fs/Ns)
+    def frequency_response(self, f):
         Bt = self.bandwidth
-        HC = 1.0 * ((-Bt <= f) & (f < Bt))
-        S = np.fft.fftshift(np.fft.fft(s)) / fs
-        R0 = S * HC
-        r = fs * np.fft.ifft(np.fft.ifftshift(R0))
-        r = np.real(r)
-        return r
+        return 1.0 * ((-Bt <= f) & (f < Bt))
 
 
 class IdealLowpass_ChannelFrequency_Widget(ChannelFrequency_Widget):
@@ -85,17 +153,9 @@ class FirstOrderLowpass_ChannelFrequency(ChannelFrequency):
     def __init__(self, cutoff_frequency=5.0):
         self.cutoff_frequency = cutoff_frequency
 
-    def process(self, s):
-        fs = self.system.samp_freq
-        Ns = len(s)
+    def frequency_response(self, f):
         f0 = self.cutoff_frequency
-        f = np.arange(-Ns//2, Ns//2) * (fs/Ns)
-        HC = 1.0 / (1.0 + 1j * 2.0 * np.pi * f/f0)
-        S = np.fft.fftshift(np.fft.fft(s)) / fs
-        R0 = S * HC
-        r = fs * np.fft.ifft(np.fft.ifftshift(R0))
-        r = np.real(r)
-        return r
+        return 1.0 / (1.0 + 1j * 2.0 * np.pi * f/f0)
 
 
 class FirstOrderLowpass_ChannelFrequency_Widget(ChannelFrequency_Widget):
@@ -127,7 +187,7 @@ class FirstOrderLowpass_ChannelFrequency_Widget(ChannelFrequency_Widget):
 
 
 choices = [
-    ('[Bypass]', Bypass_ChannelFrequency()),
-    ('Ideal lowpass', IdealLowpass_ChannelFrequency()),
-    ('First order lowpass', FirstOrderLowpass_ChannelFrequency()),
+    ('[Bypass]', Bypass_ChannelFrequency),
+    ('Ideal lowpass', IdealLowpass_ChannelFrequency),
+    ('First order lowpass', FirstOrderLowpass_ChannelFrequency),
 ]
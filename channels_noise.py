@@ -33,14 +33,20 @@ class AWGN_ChannelNoise(ChannelNoise):
     def __init__(self, snr_db=30.0):
         self.snr_db = snr_db
 
-    def process(self, s, fs=None):
+    def out_shape(self, s):
+        return s.shape
+
+    def noise(self, n, signal_power, dtype):
         sps = self.system.sps
         snr = 10.0 ** (0.1 * self.snr_db)
-        signal_power = np.mean(s**2)
         noise_power = sps * signal_power / snr
-        w = np.random.normal(size=len(s)) * np.sqrt(noise_power)
-        r = s + w
-        return r
+        w = self.system.rng.normal(size=n).astype(dtype, copy=False)
+        w *= np.sqrt(noise_power)
+        return w
+
+    def process(self, s, fs=None, out=None):
+        w = self.noise(len(s), np.dot(s, s) / len(s), s.dtype)
+        return np.add(w, s, out=w if out is None else out)
 
 
 class AWGN_ChannelNoise_Widget(ChannelNoise_Widget):
@@ -72,6 +78,6 @@ class AWGN_ChannelNoise_Widget(ChannelNoise_Widget):
 
 
 choices = [
-    ('[Bypass]', Bypass_ChannelNoise()),
-    ('AWGN', AWGN_ChannelNoise())
+    ('[Bypass]', Bypass_ChannelNoise),
+    ('AWGN', AWGN_ChannelNoise)
 ]
@@ -27,6 +27,7 @@ class Simple_Encoder(Encoder):
 
     def process(self, y):
         self.system.signaling = self.signaling
+        self.system.levels = self.signaling.levels.astype(self.system.dtype)  # Amplitudes of the symbol indices
 
         self.system.n_symbols = self.system.n_bits * 1 # TODO: Binary so far...
         return self.signaling.encode(y)
@@ -51,5 +52,5 @@ class Simple_Encoder_Widget(Encoder_Widget):
 
 
 choices = [
-    ('Simple encoder', Simple_Encoder()),
+    ('Simple encoder', Simple_Encoder),
 ]
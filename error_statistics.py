@@ -0,0 +1,119 @@
+import numpy as np
+
+
+# Incremental error analysis: feed the sent and estimated bits chunk by chunk
+# with update(); only small carry-over state is kept between chunks.
+
+class ErrorStatistics:
+    def __init__(self, pattern_len=2, frame_len=1000, keep_positions=True):
+        self.pattern_len = pattern_len  # Number of preceding bits in the ISI signature
+        self.frame_len = frame_len
+        self.keep_positions = keep_positions
+        self.reset()
+
+    def reset(self):
+        L = self.pattern_len
+        self.n_bits = 0
+        self.n_errors = 0
+        self._positions = []
+        self._bursts = np.zeros(1, dtype=np.int64)
+        self._open_burst = 0
+        self._history = np.zeros(0, dtype=np.int64)
+        self.pattern_counts = np.zeros(2**(L + 1), dtype=np.int64)
+        self.pattern_errors = np.zeros(2**(L + 1), dtype=np.int64)
+        self._frames = []
+
+    def update(self, bits, bits_hat):
+        bits = np.asarray(bits)
+        e = np.asarray(bits != bits_hat, dtype=np.int8)
+        if e.size == 0:
+            return
+        positions = np.flatnonzero(e)
+
+        self._updateBursts(e)
+        self._updatePatterns(bits, e)
+        self._updateFrames(positions, len(e))
+
+        if self.keep_positions:
+            self._positions.append(positions + self.n_bits)
+        self.n_bits += len(e)
+        self.n_errors += len(positions)
+
+    def _updateBursts(self, e):
+        # Run-length encoding of the error indicator
+        d = np.diff(np.concatenate([[0], e, [0]]))
+        starts = np.flatnonzero(d == 1)
+        lengths = np.flatnonzero(d == -1) - starts
+        if self._open_burst:
+            if starts.size and starts[0] == 0:
+                lengths[0] += self._open_burst
+            else:
+                self._addBursts([self._open_burst])
+            self._open_burst = 0
+        if e[-1]:  # The last burst may continue in the next chunk
+            self._open_burst = int(lengths[-1])
+            lengths = lengths[:-1]
+        self._addBursts(lengths)
+
+    def _addBursts(self, lengths):
+        counts = np.bincount(np.asarray(lengths, dtype=np.int64))
+        if len(counts) > len(self._bursts):
+            counts[:len(self._bursts)] += self._bursts
+            self._bursts = counts
+        else:
+            self._bursts[:len(counts)] += counts
+
+    def _updatePatterns(self, bits, e):
+        L = self.pattern_len
+        h = len(self._history)
+        ext = np.concatenate([self._history, bits.astype(np.int64)])
+        k0 = max(L, h)
+        if len(ext) > k0:
+            idx = np.zeros(len(ext) - k0, dtype=np.int64)
+            for j in range(L + 1):  # Bit j of the index is the bit j positions back
+                idx |= ext[k0 - j : len(ext) - j] << j
+            n = len(self.pattern_counts)
+            self.pattern_counts += np.bincount(idx, minlength=n)
+            self.pattern_errors += np.bincount(idx, weights=e[k0 - h:], minlength=n).astype(np.int64)
+        self._history = ext[max(len(ext) - L, 0):]
+
+    def _updateFrames(self, positions, n):
+        F = self.frame_len
+        first = self.n_bits // F
+        last = (self.n_bits + n - 1) // F
+        counts = np.bincount((positions + self.n_bits) // F - first, minlength=last - first + 1)
+        if self.n_bits % F != 0:  # First frame continues from the previous chunk
+            self._frames[-1][-1] += counts[0]
+            counts = counts[1:]
+        if counts.size:
+            self._frames.append(counts)
+
+    @property
+    def ber(self):
+        return self.n_errors / self.n_bits if self.n_bits else 0.0
+
+    @property
+    def positions(self):
+        if not self._positions:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(self._positions)
+
+    @property
+    def burst_histogram(self):  # Entry k is the number of bursts of length k
+        hist = self._bursts.copy()
+        if self._open_burst:
+            if self._open_burst >= len(hist):
+                hist = np.concatenate([hist, np.zeros(self._open_burst - len(hist) + 1, dtype=np.int64)])
+            hist[self._open_burst] += 1
+        return hist
+
+    @property
+    def frame_errors(self):
+        if not self._frames:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(self._frames)
+
+    @property
+    def pattern_ber(self):  # Indexed by the bit pattern, current bit as the LSB
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.pattern_errors / self.pattern_counts
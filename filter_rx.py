@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.fft
 
 from PyQt5 import QtCore, QtWidgets
 
@@ -32,28 +33,99 @@ class Bypass_ReceiveFilter(ReceiveFilter):
 # Matched filter
 
 class MatchedFilter_ReceiveFilter(ReceiveFilter):
-    def process(self, y):
-        pulse = self.system.blocks[2].box.pulse  # FIXME: Refactor
+    tx_filter = None  # Connected by the simulator
+    _taps_key = None
+    _spectrum_key = None
+    min_fft_taps = 128  # Shorter pulses are as fast to convolve directly
+    block_size = 2**16  # Samples of y convolved at a time
+
+    def taps(self):
+        # Time-reversed transmit pulse with unit energy, and the index of the sample at t = 0
+        tx_filter = self.tx_filter
         sps = self.system.sps
-        Ts = self.system.symbol_rate
-        fa = self.system.samp_freq
-
-        if isinstance(pulse, pulses.ShortPulse):
-            N = (pulse.filt_len + 1) * sps
-            delay = (N - 1) / fa - Ts
+        key = (sps, self.system.dtype, tx_filter.pulse.key())
+        if key != self._taps_key:
+            p, _ = tx_filter.taps()
+            p = p[::-1]
+            if isinstance(tx_filter.pulse, pulses.ShortPulse):
+                p = np.concatenate((p, np.zeros(sps, p.dtype)))
+            p = p / (np.sum(np.abs(p)**2) / sps)
+            self._taps, self._taps_key = (p, len(p)//2 - 1), key
+        return self._taps
+
+    def out_shape(self, y):
+        return y.shape
+
+    def process(self, y, out=None):
+        segments = self.tx_filter.pulse.segments
+        if segments is not None and self.system.sps % len(segments) == 0:
+            return self._integrateAndDump(y, segments, out)
+
+        p, delay = self.taps()
+        sps = self.system.sps
+        n, L = len(y), len(p)
+        if out is None:
+            out = np.empty(self.out_shape(y), p.dtype)
+
+        # Overlap-add: each block of y is convolved with the taps (through the FFT for long pulses) and added
+        # into out, where sample k is sample k + delay of the full convolution
+        if L < self.min_fft_taps:
+            block = self.block_size
         else:
-            N = pulse.filt_len * sps
-            delay = (N - 1) / fa
-
-        t = np.arange(N) / sps
-        p = pulse.pulse(-t + delay)
-        p /= np.sum(np.abs(p)**2) / sps
-
-        r = np.convolve(y, p) / sps
-
-        return r[N//2 - 1: len(y) + N//2 - 1]
+            n_fft = scipy.fft.next_fast_len(self.block_size + L - 1, real=True)
+            block = n_fft - L + 1
+            P = self.spectrum(n_fft)
+        out[:] = 0.0
+        for i in range(0, n, block):
+            x = y[i : i + block]
+            if L < self.min_fft_taps:
+                r = np.convolve(x, p)
+            else:
+                r = scipy.fft.irfft(scipy.fft.rfft(x, n_fft) * P, n_fft)
+            k = i - delay
+            a, b = max(-k, 0), min(len(x) + L - 1, n - k)
+            if a < b:
+                out[k + a : k + b] += r[a:b]
+        out /= sps
+
+        return out
+
+    def spectrum(self, n_fft):
+        # Taps on the rfft grid of n_fft samples, cached
+        p, _ = self.taps()
+        key = (n_fft, self._taps_key)
+        if key != self._spectrum_key:
+            self._spectrum, self._spectrum_key = scipy.fft.rfft(p, n_fft), key
+        return self._spectrum
+
+    def _integrateAndDump(self, y, segments, out=None):
+        # Matched to a piecewise-constant pulse: the correlation of y[n : n + sps] with the pulse is a
+        # weighted sum of the integrals of y over each piece, taken as differences of one cumulative sum
+        # (in float64, as it grows along the whole signal)
+        sps = self.system.sps
+        L = sps // len(segments)
+        n = len(y)
+        if out is None:
+            out = np.empty(self.out_shape(y), self.system.dtype)
+
+        C = np.empty(n + sps + 1)
+        C[0] = 0.0
+        np.cumsum(y, out=C[1 : n + 1])
+        C[n + 1:] = C[n]
+
+        c = np.concatenate(([0.0], segments, [0.0]))
+        weights = (c[:-1] - c[1:]) / (L * np.sum(np.square(segments)))  # Weight of C[n + b*L], b = 0, ..., len(segments)
+        for k0 in range(0, n, self.block_size):
+            k1 = min(k0 + self.block_size, n)
+            acc = weights[0] * C[k0:k1]
+            for (b, w) in enumerate(weights[1:], start=1):
+                if w != 0.0:
+                    acc += w * C[b*L + k0 : b*L + k1]
+            out[k0:k1] = acc
+
+        return out
 
 choices = [
-    ('[Bypass]', Bypass_ReceiveFilter()),
-    ('Matched to transmit filter', MatchedFilter_ReceiveFilter()),
+    ('[Bypass]', Bypass_ReceiveFilter),
+    ('Matched to transmit filter', MatchedFilter_ReceiveFilter),
 ]
@@ -1,3 +1,5 @@
+import collections
+
 import numpy as np
 
 from PyQt5 import QtCore, QtWidgets
@@ -25,30 +27,113 @@ class TransmitFilter_Widget(QtWidgets.QWidget):
 # Pulse formatter
 
 class PulseFormatter_TransmitFilter(TransmitFilter):
-    pulse = list(pulses.collection.values())[0]
-
-    def process(self, x):
+    _taps_key = None
+    _polyphase = None
+    _table_key = None
+    use_table = True  # Synthesize from a table of symbol-period segments when the pulse is short enough
+    max_table_rows = 4096  # M**J for M levels and a pulse spanning J symbols
+    min_table_taps = 64  # Shorter pulses are as fast to filter as to gather
+
+    def __init__(self):
+        self.pulses = collections.OrderedDict((name, factory()) for (name, factory) in pulses.collection.items())
+        self.pulse = list(self.pulses.values())[0]
+
+    def taps(self):
+        # Pulse samples and the index of the sample at t = 0, cached per pulse and sps
         sps = self.system.sps
-        filt_len = self.pulse.filt_len
-        N = sps * filt_len
-
-        t = np.arange(N) / sps
-        p = self.pulse.pulse(t)
-        w = np.zeros((len(x) + 2) * sps)
-        w[sps : -sps : sps] = x
+        dtype = self.system.dtype
+        key = (sps, dtype, self.pulse.key())
+        if key != self._taps_key:
+            p, delay = self.pulse.taps(sps)
+            self._taps, self._taps_key = (p.astype(dtype), delay), key
+            self._polyphase = None
+        return self._taps
+
+    def polyphase(self):
+        # Taps split into rows of sps samples, (P, D), such that row r of the output is
+        # sum_j x[r + D - 1 - j] * P[j]
+        p, delay = self.taps()
+        if self._polyphase is None:
+            sps = self.system.sps
+            pad = -delay % sps
+            p = np.concatenate((np.zeros(pad, p.dtype), p, np.zeros(-(pad + len(p)) % sps, p.dtype)))
+            self._polyphase = (p.reshape(-1, sps), (delay + pad) // sps)
+        return self._polyphase
+
+    def table(self, levels):
+        # Output row for every window of J symbol indices: row sum_j i_j * M**(J-1-j) is
+        # sum_j levels[i_j] * P[J-1-j], matching the windows of process(). None if there would be too many.
+        P, D = self.polyphase()
+        J, M = len(P), len(levels)
+        if M**J > self.max_table_rows:
+            return None
+        key = (self._taps_key, tuple(levels))
+        if key != self._table_key:
+            T = np.zeros((1, P.shape[1]), P.dtype)
+            for j in range(J):
+                T = (T[:, np.newaxis, :] + np.asarray(levels, P.dtype)[:, np.newaxis] * P[J - 1 - j]).reshape(-1, P.shape[1])
+            self._table, self._table_key = T, key
+        return self._table
+
+    def out_shape(self, x):
+        return ((len(x) + 2) * self.system.sps,)
+
+    def process(self, x, out=None):
+        # x: symbol indices into system.levels
+        segments = self.pulse.segments
+        if segments is not None and self.system.sps % len(segments) == 0:
+            return self._processSegments(x, segments, out)
+
+        # Equivalent to convolving the pulse with the zero-stuffed symbols, one row of sps samples per symbol
+        P, D = self.polyphase()
+        J = len(P)
+        n_rows = len(x) + 2
+        if out is None:
+            out = np.empty(self.out_shape(x), P.dtype)
+
+        levels = self.system.levels
+        xp = np.zeros(n_rows + J - 1, P.dtype)
+        i0, i1 = max(J - D, 0), min(J - D + len(x), len(xp))
+        xp[i0:i1] = levels[x[i0 - (J - D) : i1 - (J - D)]]
+        X = np.lib.stride_tricks.sliding_window_view(xp, J)  # X[r, j] = levels[x[r + D - J + j]]
+        rows = out.reshape(n_rows, -1)
+
+        # Rows whose window lies within the symbols: gathered from the table
+        r0 = r1 = 0
+        T = self.table(levels) if self.use_table and P.size >= self.min_table_taps else None
+        s0, s1 = max(D - J, 0), min(len(x) - J + 1, n_rows + D - J)  # First symbol of the windows
+        if T is not None and s1 > s0:
+            codes = np.zeros(s1 - s0, dtype=np.intp)
+            for j in range(J):
+                codes *= len(levels)
+                codes += x[s0 + j : s1 + j]
+            r0, r1 = s0 + J - D, s1 + J - D
+            np.take(T, codes, axis=0, out=rows[r0:r1])
+
+        np.matmul(X[:r0], P[::-1], out=rows[:r0])
+        np.matmul(X[r1:], P[::-1], out=rows[r1:])
+
+        return out
+
+    def _processSegments(self, x, segments, out=None):
+        # Piecewise-constant pulse of one symbol: one row of sps samples per symbol, the symbol times the
+        # levels repeated over their pieces
+        sps = self.system.sps
+        dtype = self.system.dtype
+        if out is None:
+            out = np.empty(self.out_shape(x), dtype)
 
-        s = np.convolve(w, p)
+        rows = out.reshape(len(x) + 2, sps)
+        rows[0] = rows[-1] = 0.0
+        np.multiply(self.system.levels[x][:, np.newaxis], np.repeat(np.array(segments, dtype), sps // len(segments)), out=rows[1:-1])
 
-        if isinstance(self.pulse, pulses.ShortPulse):
-            return s[: len(w)]
-        else:
-            return s[N//2 : len(w) + N//2]
+        return out
 
 
 class PulseFormatter_TransmitFilter_Widget(TransmitFilter_Widget):
     def initUI(self):
         self.pulses_combo = QtWidgets.QComboBox()
-        self.pulses_combo.addItems(list(pulses.collection.keys()))
+        self.pulses_combo.addItems(list(self.tx_filter.pulses.keys()))
         self.pulses_combo.activated[str].connect(self.onChangePulse)
 
         layout_top = QtWidgets.QHBoxLayout()
@@ -57,7 +142,7 @@ class PulseFormatter_TransmitFilter_Widget(TransmitFilter_Widget):
 
         layout_pulses = QtWidgets.QVBoxLayout()
         self.pulse_widgets = {}
-        for i, (key, val) in enumerate(pulses.collection.items()):
+        for i, (key, val) in enumerate(self.tx_filter.pulses.items()):
             w = val.widget()
             w.setVisible(i == 0)
             if hasattr(w, 'update_signal'):
@@ -71,13 +156,13 @@ class PulseFormatter_TransmitFilter_Widget(TransmitFilter_Widget):
         self.setLayout(layout)
 
     def onChangePulse(self, text):
-        self.tx_filter.pulse = pulses.collection[text]
-        for key in pulses.collection.keys():
+        self.tx_filter.pulse = self.tx_filter.pulses[text]
+        for key in self.tx_filter.pulses.keys():
             self.pulse_widgets[key].setVisible(key == text)
         self.update_signal.emit()
 
 
 choices = [
-    ('Pulse formatter', PulseFormatter_TransmitFilter()),
+    ('Pulse formatter', PulseFormatter_TransmitFilter),
 ]
 
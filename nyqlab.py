@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
 import functools
+import math
+import os
 import sys
+import traceback
 
 from PyQt5 import QtGui, QtWidgets, QtCore
 
 import sources, encoder, filter_tx, channels_frequency, channels_noise, filter_rx, sampler, decoder
 
-from system_simulator import SystemSimulator, Block
+from system_simulator import SystemSimulator, Block, physical_memory
 from system_diagram import SystemDiagram, BlockD, ConnectionD
 
 from window_scope import WindowScope
@@ -27,23 +30,31 @@ class MainWindow(QtWidgets.QMainWindow):
         self.window_scope = WindowScope(parent=self, system=self.system)
         self.window_pulse = WindowPulse(parent=self, system=self.system)
 
+        self.compute_pending = False
+        self.compute_running = False
+        self.compute_thread = ComputeThread(self)
+        self.compute_thread.finished.connect(self.onComputeFinished)
+
     def setupSystem(self):
         blocks_s = [
-            Block(sources, 'D'),
-            Block(encoder, 'D'),
-            Block(filter_tx, 'C'),
-            Block(channels_frequency, 'C'),
-            Block(channels_noise, 'C'),
-            Block(filter_rx, 'C'),
-            Block(sampler, 'D'),
-            Block(decoder, 'D'),
+            Block(sources, 'D', 'source'),
+            Block(encoder, 'D', 'encoder'),
+            Block(filter_tx, 'C', 'tx_filter'),
+            Block(channels_frequency, 'C', 'channel'),
+            Block(channels_noise, 'C', 'noise'),
+            Block(filter_rx, 'C', 'rx_filter'),
+            Block(sampler, 'D', 'sampler'),
+            Block(decoder, 'D', 'decoder'),
         ]
 
         self.system = SystemSimulator(blocks_s)
 
-        # Ugly monkey patch:
-        for block in self.system.blocks:
-            block.box.system = self.system
+        self.system.workers = os.cpu_count() or 1
+
+        # Stay within half of the RAM; stages not shown in the scope are dropped first
+        memory = physical_memory()
+        if memory is not None:
+            self.system.memory_budget = memory // 2
 
     def setupSystemDiagram(self):
         blocks_d = [
@@ -85,14 +96,14 @@ class MainWindow(QtWidgets.QMainWindow):
         layout.addWidget(QtWidgets.QLabel('<b>{}:</b>'.format(block_name)))
 
         combo = QtWidgets.QComboBox(self)
-        for name, obj in block.module.choices:
+        for (name, _) in block.module.choices:
             combo.addItem(name)
         combo.activated[int].connect(functools.partial(self.onBlockComboActivated, idx))
         layout.addWidget(combo)
 
         block_choice = []
-        for idx_choice, (name, obj) in enumerate(block.module.choices):
-            w = obj.widget()
+        for idx_choice, box in enumerate(block.boxes):
+            w = box.widget()
             w.setVisible(idx_choice == 0)
             if hasattr(w, 'update_signal'):
                 w.update_signal.connect(self.compute_and_plot)
@@ -135,6 +146,14 @@ class MainWindow(QtWidgets.QMainWindow):
         action_view_pulse = QtWidgets.QAction(QtGui.QIcon('media/pulse'), 'Pulse', self)
         action_view_pulse.triggered.connect(self.showWindowPulse)
 
+        action_profile = QtWidgets.QAction(QtGui.QIcon.fromTheme('appointment-soon'), 'Profile', self)
+        action_profile.setCheckable(True)
+        action_profile.triggered.connect(self.toggleProfile)
+
+        action_auto_sps = QtWidgets.QAction(QtGui.QIcon.fromTheme('zoom-fit-best'), 'Auto sps', self)
+        action_auto_sps.setCheckable(True)
+        action_auto_sps.triggered.connect(self.toggleAutoSps)
+
         action_always_on_top = QtWidgets.QAction(QtGui.QIcon.fromTheme('go-top'), 'Always on top', self)
         action_always_on_top.setCheckable(True)
         action_always_on_top.triggered.connect(self.toggleAlwaysOnTop)
@@ -145,6 +164,8 @@ class MainWindow(QtWidgets.QMainWindow):
         toolbar.addAction(action_view_scope)
         toolbar.addAction(action_view_pulse)
         toolbar.addSeparator()
+        toolbar.addAction(action_auto_sps)
+        toolbar.addAction(action_profile)
         toolbar.addAction(action_always_on_top)
 
         # Main layout
@@ -173,19 +194,23 @@ class MainWindow(QtWidgets.QMainWindow):
         self.panel_options_general.setVisible(True)
 
     def onBlockComboActivated(self, idx_block, idx_choice):
-        block = self.system.blocks[idx_block]
-
         for (i, widget) in enumerate(self.block_choices[idx_block]):
             widget.setVisible(i == idx_choice)
 
-        block.box = block.module.choices[idx_choice][1]
-        block.box.system = self.system
+        self.system.select(idx_block, idx_choice)
+        if hasattr(self.block_choices[idx_block][idx_choice], 'refresh'):
+            self.block_choices[idx_block][idx_choice].refresh()  # Show the state of the simulator
 
         self.compute_and_plot()
 
     def toggleSignal(self, idx):
         self.system_diagram.connections_d[idx].visible ^= True
         self.window_scope.update_visible()
+        if self.system_diagram.connections_d[idx].visible and self.system.data_t[idx] is None:
+            self.compute_and_plot()  # Not kept by the last run
+
+    def _updateRequested(self):
+        self.system.requested = {i for (i, c) in enumerate(self.system_diagram.connections_d) if c.visible}
 
     def showWindowScope(self):
         self.window_scope.show()
@@ -193,6 +218,14 @@ class MainWindow(QtWidgets.QMainWindow):
     def showWindowPulse(self):
         self.window_pulse.show()
 
+    def toggleAutoSps(self):
+        self.system.auto_sps ^= True
+        self.compute_and_plot()
+
+    def toggleProfile(self):
+        self.system.profile ^= True
+        self.compute_and_plot()
+
     def toggleAlwaysOnTop(self):
         self.always_on_top ^= True
         if self.always_on_top:
@@ -202,13 +235,48 @@ class MainWindow(QtWidgets.QMainWindow):
         self.show()
 
     def compute_and_plot(self):
-        self.compute()
-        self.window_scope.plot()
-        self.window_pulse.plot()
+        # Simulations run in the background; requests arriving meanwhile are coalesced and the
+        # running simulation is abandoned, so that only the newest parameters are computed
+        self.compute_pending = True
+        if self.compute_running:
+            self.compute_thread.requestInterruption()
+        else:
+            self._startCompute()
+
+    def _startCompute(self):
+        self._updateRequested()
+        self.compute_pending = False
+        self.compute_running = True
+        self.compute_thread.start()
+
+    def onComputeFinished(self):
+        self.compute_thread.wait()
+        self.compute_running = False
+        if self.compute_pending:
+            self._startCompute()
+        elif self.compute_thread.completed:
+            self.updateBer()
+            self.panel_options_general.refresh()  # The sps may have been chosen automatically
+            if self.system.profile:
+                self.system_diagram.showProfile(self.system.profile_records)
+            else:
+                self.system_diagram.clearProfile()
+            self.window_scope.plot()
+            self.window_pulse.refresh()
+
+    def isComputing(self):
+        return self.compute_running or self.compute_pending
 
     def compute(self):
+        self._updateRequested()
+        self.system.process()
+        self.updateBer()
+
+    def updateBer(self):
         def _format_ber(value):
-            if value == 0:
+            if math.isnan(value):
+                return 'no sync'
+            elif value == 0:
                 return '0'
             elif value >= 1e-2:
                 f = '{:.3g}'.format(100 * value)
@@ -218,8 +286,35 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 return '{:.2e}'.format(value)
 
-        self.system.process()
-        self.ber_text.setText('<b>BER:</b> ' + _format_ber(self.system.ber))
+        text = '<b>BER:</b> ' + _format_ber(self.system.ber)
+        if self.system.prbs_ber is not None:
+            text += ' &nbsp; <b>PRBS checker:</b> ' + _format_ber(self.system.prbs_ber)
+        if self.system.bathtub is not None:
+            text += ' &nbsp; <b>Sampling instant:</b> {:.1f}% of Ts'.format(100 * self.system.sampling_instant)
+        if self.system.plan is not None and self.system.plan['mode'] != 'full':
+            text += ' &nbsp; <i>({})</i>'.format(self.system.describe_plan())
+        self.ber_text.setText(text)
+
+    def closeEvent(self, event):
+        self.compute_thread.requestInterruption()
+        self.compute_thread.wait()
+        super().closeEvent(event)
+
+
+class ComputeThread(QtCore.QThread):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.parent = parent
+        self.completed = False
+
+    def run(self):
+        try:
+            self.completed = self.parent.system.process(should_stop=self.isInterruptionRequested)
+            if self.completed:
+                self.parent.window_pulse.compute()
+        except Exception:
+            traceback.print_exc()
+            self.completed = False
 
 
 class PanelOptions(QtWidgets.QWidget):
@@ -247,6 +342,10 @@ class PanelOptions(QtWidgets.QWidget):
 
         self.setLayout(layout)
 
+    def refresh(self):
+        for key in self.options:
+            self.text[key].setText(str(getattr(self.obj, key)))
+
     def onChange_text(self, key):
         old_value = getattr(self.obj, key)
         new_value = (type(old_value))(self.text[key].text())
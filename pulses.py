@@ -1,11 +1,24 @@
 import collections
+import copy
 
 import numpy as np
 
+from scipy.signal import get_window
+
 from PyQt5 import QtCore, QtWidgets
 
 
 class Pulse:
+    params = ('filt_len',)
+    segments = None  # Piecewise-constant pulses over one symbol: levels of the equal-length pieces
+
+    def key(self):  # Identifies the pulse and its parameters
+        return (self.__class__.__name__,) + tuple(getattr(self, p) for p in self.params)
+
+    def taps(self, sps):  # Samples of the pulse and the index of the sample at t = 0
+        N = sps * self.filt_len
+        return self.pulse(np.arange(N) / sps), 0
+
     def widget(self):
         try:
             return globals()[self.__class__.__name__ + '_Widget'](self)
@@ -29,24 +42,150 @@ class ShortPulse(Pulse):
 
 
 class LongPulse(Pulse):
+    params = ('filt_len', 'energy_fraction', 'window')
     filt_len = 64
+    energy_fraction = 1.0  # Keeps the shortest centered span with this fraction of the energy
+    window = None  # Applied over the kept span, as named in scipy.signal.get_window
     ax_t_lim = [-7.5, +7.5, -0.5, 1.25]
     ax_f_lim = [-1.5, 1.5, -0.25, 1.25]
 
+    def taps(self, sps):
+        N = sps * self.filt_len
+        p = self.pulse(np.arange(N) / sps)
+        delay = N//2
+        if self.energy_fraction < 1.0:
+            e = p**2
+            m = min(delay, N - delay)
+            e_span = np.cumsum(e[delay - 1 :: -1][:m] + e[delay : delay + m])  # Span [delay - h, delay + h), h = 1, 2, ...
+            h = min(int(np.searchsorted(e_span, self.energy_fraction * np.sum(e))) + 1, m)
+            p, delay = p[delay - h : delay + h], h
+        if self.window is not None:
+            p = p * get_window(self.window, len(p), fftbins=False)
+        return p, delay
+
+
+def truncation_report(pulse, sps):
+    # Effect of the truncation and window of a long pulse, relative to the full-length pulse, both with
+    # unit energy: error of the matched-filtered pulse at the symbol instants (ISI), relative to its peak,
+    # and error of the energy spectrum, relative to the total energy
+    reference = copy.copy(pulse)
+    reference.energy_fraction, reference.window = 1.0, None
+    q, d_q = reference.taps(sps)
+    p, d_p = pulse.taps(sps)
+    q = q / np.sqrt(np.sum(q**2))
+    p = p / np.sqrt(np.sum(p**2))
+
+    # Align p with q, then compare the autocorrelations (pulse through its matched filter) every sps samples
+    p_aligned = np.zeros(len(q))
+    start = d_q - d_p
+    p_aligned[start : start + len(p)] = p
+    c = len(q) - 1
+    h_q = np.convolve(q, q[::-1])[c % sps :: sps]
+    h_p = np.convolve(p_aligned, p_aligned[::-1])[c % sps :: sps]
+    isi_error = np.sum(np.abs(h_p - h_q)) / h_q[c // sps]
+
+    n_fft = 2**int(np.ceil(np.log2(4 * len(q))))
+    psd_error = np.sum(np.abs(np.abs(np.fft.rfft(p, n_fft))**2 - np.abs(np.fft.rfft(q, n_fft))**2)) / (n_fft / 2)
+
+    with np.errstate(divide='ignore'):
+        return {
+            'taps': len(p),
+            'span': len(p) / sps,
+            'isi_error_db': 20.0 * np.log10(isi_error),
+            'psd_error_db': 10.0 * np.log10(psd_error),
+        }
+
+
+def worst_case_eye(h, sps, center, levels):
+    # Peak-distortion analysis of an effective pulse h, whose cursor for symbol k at sampling offset j
+    # (in samples, from -sps//2 to sps//2 - 1) is h[center + j + k*sps]. For every offset, with any sequence
+    # of the given levels (a bound for signaling schemes that restrict the sequences): peak distortion
+    # (sum of |ISI cursors| over the main cursor), worst-case vertical eye opening between adjacent levels,
+    # relative to the ISI-free opening, and the neighbouring symbols that close the eye the most.
+    levels = np.sort(np.asarray(levels, dtype=float))
+    start = (center - sps//2) % sps
+    K = (len(h) - start) // sps
+    H = h[start : start + K*sps].reshape(K, sps)  # Row k: cursor k - k0, column j + sps//2
+    k0 = (center - sps//2 - start) // sps
+
+    main = H[k0]
+    isi = np.sum(np.abs(H), axis=0) - np.abs(main)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distortion = isi / np.abs(main)
+    spread = levels[-1] - levels[0]
+    step = np.min(np.diff(levels)) if len(levels) > 1 else np.nan
+    eye_opening = np.sign(main) - distortion * spread / step
+
+    best = int(np.nanargmax(eye_opening)) if not np.all(np.isnan(eye_opening)) else sps//2
+    # Decision on the upper of two adjacent levels: the worst neighbours pull towards the lower one
+    cursors = H[:, best].copy()
+    pattern = np.where(cursors * np.sign(main[best]) > 0, levels[0], levels[-1])
+    pattern[k0] = levels[-1]
+
+    offsets = (np.arange(sps) - sps//2) / sps
+    return {
+        'offsets': offsets,
+        'main': main,
+        'peak_distortion': distortion,
+        'eye_opening': eye_opening,
+        'best': offsets[best],
+        'cursors': cursors,
+        'cursor_index': np.arange(K) - k0,
+        'worst_pattern': pattern,
+    }
+
+
+class LongPulse_Widget(Pulse_Widget):
+    windows = ['[None]', 'hann', 'hamming', 'blackman', 'blackmanharris']
+
+    def _addTruncationOptions(self, layout, row):
+        self.energy_fraction_text = QtWidgets.QLineEdit()
+        self.energy_fraction_text.editingFinished.connect(
+            lambda: self._update('energy_fraction', float(self.energy_fraction_text.text()))
+        )
+
+        self.window_combo = QtWidgets.QComboBox()
+        self.window_combo.addItems(self.windows)
+        self.window_combo.activated[int].connect(
+            lambda idx: self._update('window', self.windows[idx] if idx > 0 else None)
+        )
+
+        layout.addWidget(QtWidgets.QLabel('Energy fraction:'), row, 0, 1, 1)
+        layout.addWidget(self.energy_fraction_text, row, 1, 1, 2)
+        layout.addWidget(QtWidgets.QLabel('Window:'), row + 1, 0, 1, 1)
+        layout.addWidget(self.window_combo, row + 1, 1, 1, 2)
+
+        self._update('energy_fraction', self.pulse.energy_fraction)
+        self._update('window', self.pulse.window)
+
+    def _updateTruncation(self, key, value):
+        if key == 'energy_fraction':
+            value = min(max(value, 0.5), 1.0)
+            self.pulse.energy_fraction = value
+            self.energy_fraction_text.setText(str(value))
+        elif key == 'window':
+            self.pulse.window = value
+            self.window_combo.setCurrentIndex(self.windows.index(value) if value is not None else 0)
+
 
 # Short pulses
 
 class RectangularNRZ_Pulse(ShortPulse):
+    segments = (1.0,)
+
     def pulse(self, t):
         return 1.0 * ((0.0 <= t) & (t < 1.0))
 
 
 class RectangularRZ_Pulse(ShortPulse):
+    segments = (1.0, 0.0)
+
     def pulse(self, t):
         return 1.0 * ((0.0 <= t) & (t < 0.5))
 
 
 class Manchester_Pulse(ShortPulse):
+    segments = (1.0, -1.0)
     ax_t_lim = [-0.5, 1.5, -1.25, 1.25]
 
     def pulse(self, t):
@@ -55,6 +194,7 @@ class Manchester_Pulse(ShortPulse):
 
 
 class Wal2_Pulse(ShortPulse):
+    segments = (-1.0, 1.0, 1.0, -1.0)
     ax_t_lim = [-0.5, 1.5, -1.25, 1.25]
 
     def pulse(self, t):
@@ -77,7 +217,7 @@ class Sinc_Pulse(LongPulse):
         return np.sinc(t) * ((-t0 <= t) & (t < t0))
 
 
-class Sinc_Pulse_Widget(Pulse_Widget):
+class Sinc_Pulse_Widget(LongPulse_Widget):
     def initUI(self):
         self.filt_len_text = QtWidgets.QLineEdit(str(self.pulse.filt_len))
         self.filt_len_text.editingFinished.connect(
@@ -87,6 +227,7 @@ class Sinc_Pulse_Widget(Pulse_Widget):
         layout = QtWidgets.QGridLayout()
         layout.addWidget(QtWidgets.QLabel('Filter length [Ts]:'), 0, 0, 1, 1)
         layout.addWidget(self.filt_len_text, 0, 1, 1, 2)
+        self._addTruncationOptions(layout, 1)
         self.setLayout(layout)
 
         self._update('filt_len', self.pulse.filt_len)
@@ -95,6 +236,8 @@ class Sinc_Pulse_Widget(Pulse_Widget):
         if key == 'filt_len':
             self.pulse.filt_len = value
             self.filt_len_text.setText(str(value))
+        else:
+            self._updateTruncation(key, value)
         self.update_signal.emit()
 
 
@@ -110,6 +253,7 @@ class SquaredSinc_Pulse_Widget(Sinc_Pulse_Widget):
 
 
 class RaisedCosine_Pulse(LongPulse):
+    params = ('filt_len', 'rolloff', 'energy_fraction', 'window')
     rolloff = 0.5
 
     def pulse(self, t):
@@ -120,7 +264,7 @@ class RaisedCosine_Pulse(LongPulse):
         return p * ((-t0 <= t) & (t < t0))
 
 
-class RaisedCosine_Pulse_Widget(Pulse_Widget):
+class RaisedCosine_Pulse_Widget(LongPulse_Widget):
     def initUI(self):
         self.filt_len_text = QtWidgets.QLineEdit()
         self.filt_len_text.editingFinished.connect(
@@ -144,6 +288,7 @@ class RaisedCosine_Pulse_Widget(Pulse_Widget):
         layout.addWidget(QtWidgets.QLabel('Rolloff factor:'), 1, 0, 1, 1)
         layout.addWidget(self.rolloff_text, 1, 1, 1, 1)
         layout.addWidget(self.rolloff_slider, 1, 2, 1, 1)
+        self._addTruncationOptions(layout, 2)
         self.setLayout(layout)
 
         self._update('filt_len', self.pulse.filt_len)
@@ -157,10 +302,13 @@ class RaisedCosine_Pulse_Widget(Pulse_Widget):
             self.pulse.rolloff = float(value)
             self.rolloff_text.setText(str(value))
             self.rolloff_slider.setValue(int(100 * value))
+        else:
+            self._updateTruncation(key, value)
         self.update_signal.emit()
 
 
 class RootRaisedCosine_Pulse(LongPulse):
+    params = ('filt_len', 'rolloff', 'energy_fraction', 'window')
     rolloff = 0.5
 
     def pulse(self, t):
@@ -185,13 +333,13 @@ class RootRaisedCosine_Pulse_Widget(RaisedCosine_Pulse_Widget):
 
 
 collection = collections.OrderedDict([
-    ('Rectangular NRZ', RectangularNRZ_Pulse()),
-    ('Rectangular RZ', RectangularRZ_Pulse()),
-    ('Biphase (Manchester)', Manchester_Pulse()),
-    ('Wal-2', Wal2_Pulse()),
-    ('Triangular', Triangular_Pulse()),
-    ('Sinc', Sinc_Pulse()),
-    ('Squared sinc', SquaredSinc_Pulse()),
-    ('Raised-cosine', RaisedCosine_Pulse()),
-    ('Root-raised-cosine', RootRaisedCosine_Pulse())
+    ('Rectangular NRZ', RectangularNRZ_Pulse),
+    ('Rectangular RZ', RectangularRZ_Pulse),
+    ('Biphase (Manchester)', Manchester_Pulse),
+    ('Wal-2', Wal2_Pulse),
+    ('Triangular', Triangular_Pulse),
+    ('Sinc', Sinc_Pulse),
+    ('Squared sinc', SquaredSinc_Pulse),
+    ('Raised-cosine', RaisedCosine_Pulse),
+    ('Root-raised-cosine', RootRaisedCosine_Pulse)
 ])
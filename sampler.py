@@ -2,8 +2,47 @@ import numpy as np
 
 from PyQt5 import QtCore, QtWidgets
 
+from signaling import slicer
+
+
+def sweep(r, bits, symbols, sps, signaling):
+    # Bathtub over every whole-sample offset in [-Ts/2, Ts/2), in a single pass: column j of the
+    # (n_symbols, sps) matrix holds the samples at offset j - sps//2
+    Ns = len(symbols)
+    start = sps - sps//2
+    R = r[start : start + Ns*sps].reshape(Ns, sps)
+
+    bit_errors = np.count_nonzero(signaling.decode(R.T) != bits, axis=1)
+
+    levels = signaling.levels
+    symbol_errors = np.count_nonzero(slicer(R.T, (levels[1:] + levels[:-1]) / 2) != symbols, axis=1)
+
+    # Vertical eye opening: smallest gap between adjacent levels sent (negative if the eye is closed)
+    eye_opening = np.full(sps, np.nan)
+    sent = np.unique(symbols)
+    if len(sent) > 1:
+        lows = np.array([np.min(R[symbols == i], axis=0) for i in sent])
+        highs = np.array([np.max(R[symbols == i], axis=0) for i in sent])
+        eye_opening = np.min(lows[1:] - highs[:-1], axis=0)
+
+    offsets = (np.arange(sps) - sps//2) / sps
+    best = np.lexsort((-np.nan_to_num(eye_opening, nan=-np.inf), bit_errors))[0]  # Fewest errors, then widest eye
+    return {
+        'offsets': offsets,
+        'ber': bit_errors / Ns,
+        'symbol_errors': symbol_errors,
+        'eye_opening': eye_opening,
+        'best': offsets[best],
+    }
+
 
 class Sampler:
+    auto = False  # If set, the sampling instant is chosen by select_instant() before each run
+
+    def select_instant(self, r, bits, symbols):
+        self.system.bathtub = sweep(r, bits, symbols, self.system.sps, self.system.signaling)
+        self.system.sampling_instant = self.system.bathtub['best']
+
     def widget(self):
         try:
             return globals()[self.__class__.__name__ + '_Widget'](self)
@@ -19,6 +58,20 @@ class Sampler_Widget(QtWidgets.QWidget):
         self.sampler = sampler
         self.initUI()
 
+    def _addAutoOption(self, layout):
+        self.auto_check = QtWidgets.QCheckBox('Auto')
+        self.auto_check.toggled.connect(self._updateAuto)
+        layout.addWidget(self.auto_check)
+
+    def _updateAuto(self, checked):
+        self.sampler.auto = checked
+        self.sampling_instant_text.setEnabled(not checked)
+        self.sampling_instant_slider.setEnabled(not checked)
+        if checked:
+            self.update_signal.emit()
+        else:
+            self.sampling_instant_text.editingFinished.emit()  # Back to the manual instant
+
 
 # Samplers
 
@@ -53,6 +106,7 @@ class Simple_Sampler_Widget(Sampler_Widget):
         layout.addWidget(QtWidgets.QLabel('Sampling instant [% of Ts]:'), 1)
         layout.addWidget(self.sampling_instant_text, 1)
         layout.addWidget(self.sampling_instant_slider, 2)
+        self._addAutoOption(layout)
         self.setLayout(layout)
 
         self._update(0)
@@ -64,6 +118,75 @@ class Simple_Sampler_Widget(Sampler_Widget):
         self.update_signal.emit()
 
 
+class Interpolating_Sampler(Sampler):
+    # Cubic Lagrange interpolation in Farrow form: the sample at n + mu is ((c3*mu + c2)*mu + c1)*mu + c0,
+    # where c = farrow @ r[n-1 : n+3]. Only evaluated at the sampling instants.
+    farrow = np.array([
+        [   0.0,  1.0,  0.0,   0.0],
+        [-1/3.0, -0.5,  1.0, -1/6.0],
+        [   0.5, -1.0,  0.5,   0.0],
+        [-1/6.0,  0.5, -0.5,  1/6.0],
+    ])
+
+    def sampling_instants(self, r):
+        sps = self.system.sps
+        Ns = self.system.n_symbols
+        s_inst = self.system.sampling_instant
+        return (s_inst + 1.0 + np.arange(Ns)) * sps  # Fractional sample indices
+
+    def process(self, r):
+        instants = self.sampling_instants(r)
+        self.system.instants = instants
+        n = np.floor(instants).astype(int)
+        mu = (instants - n).astype(r.dtype, copy=False)
+        c = r[np.clip(n[:, np.newaxis] + np.arange(-1, 3), 0, len(r) - 1)] @ self.farrow.T.astype(r.dtype, copy=False)
+        return ((c[:, 3]*mu + c[:, 2])*mu + c[:, 1])*mu + c[:, 0]
+
+
+class Interpolating_Sampler_Widget(Sampler_Widget):
+    def initUI(self):
+        self.sampling_instant_text = QtWidgets.QLineEdit()
+        self.sampling_instant_text.editingFinished.connect(
+            lambda: self._update(float(self.sampling_instant_text.text()))
+        )
+
+        self.sampling_instant_slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
+        self.sampling_instant_slider.setRange(-500, 500)  # Steps of 0.1 % of Ts
+        self.sampling_instant_slider.valueChanged[int].connect(
+            lambda: self._update(self.sampling_instant_slider.value() / 10)
+        )
+
+        layout = QtWidgets.QHBoxLayout()
+        layout.addWidget(QtWidgets.QLabel('Sampling instant [% of Ts]:'), 1)
+        layout.addWidget(self.sampling_instant_text, 1)
+        layout.addWidget(self.sampling_instant_slider, 2)
+        self._addAutoOption(layout)
+        self.setLayout(layout)
+
+        self.refresh()
+
+    def refresh(self):
+        # Shows the instant in use, which the other sampler or the automatic choice may have set
+        self._show(100 * self.sampler.system.sampling_instant)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+
+    def _show(self, value):
+        self.sampling_instant_text.setText(str(value))
+        self.sampling_instant_slider.blockSignals(True)  # The slider is coarser than the text
+        self.sampling_instant_slider.setValue(int(round(10 * value)))
+        self.sampling_instant_slider.blockSignals(False)
+
+    def _update(self, value):
+        value = min(max(value, -50.0), 50.0)
+        self.sampler.system.sampling_instant = value / 100
+        self._show(value)
+        self.update_signal.emit()
+
+
 choices = [
-    ('Simple sampler', Simple_Sampler()),
+    ('Simple sampler', Simple_Sampler),
+    ('Interpolating sampler', Interpolating_Sampler),
 ]
@@ -5,18 +5,12 @@ import numpy as np
 from PyQt5 import QtCore, QtWidgets
 
 
-def slicer(y, thresholds, values):
-    thresholds = np.hstack([-np.inf, thresholds, np.inf])
-    x_hat = np.empty_like(y)
-    for t0, t1, v in zip(thresholds[:-1], thresholds[1:], values):
-        x_hat[(t0 < y) & (y <= t1)] = v
-    return x_hat
+# Symbols are carried as int8 indices into the sorted levels of the scheme; the pulse formatter maps
+# them to amplitudes.
 
-def unmap(x, values):
-    bits = np.empty_like(x, dtype=np.int)
-    for b, v in enumerate(values):
-        bits[x == v] = b
-    return bits
+def slicer(y, thresholds):
+    # Index i of the decision region thresholds[i-1] < y <= thresholds[i]
+    return np.searchsorted(thresholds, y).astype(np.int8)
 
 
 class SignalingScheme:
@@ -31,22 +25,33 @@ class MemorylessSignalingScheme(SignalingScheme):
     def __init__(self, values, thresholds):
         self.values = np.array(values)
         self.thresholds = np.array(thresholds)
+        self.indices = np.searchsorted(self.levels, self.values).astype(np.int8)  # Symbol of each bit
+        self.bits = np.argsort(self.indices).astype(np.int8)  # Bit of each symbol (decision region)
+
+    @property
+    def levels(self):
+        return np.unique(self.values)
 
     def encode(self, bits):
-        return self.values[bits]
+        return self.indices[bits]
 
     def decode(self, y):
-        return unmap(slicer(y, self.thresholds, self.values), self.values)
+        return self.bits[slicer(y, self.thresholds)]
 
 
 class SequenceStateSignalingScheme(SignalingScheme):
     def __init__(self, finite_state_machine, ):
         self.finite_state_machine = finite_state_machine
 
+    @property
+    def levels(self):
+        return np.unique([v for (_, v) in self.finite_state_machine.values()])
+
     def encode(self, bits, initial_state=0):
-        fsm = self.finite_state_machine
+        levels = list(self.levels)
+        fsm = {k: (s, levels.index(v)) for (k, (s, v)) in self.finite_state_machine.items()}
         state = initial_state
-        x = np.empty_like(bits)
+        x = np.empty(len(bits), dtype=np.int8)
         for (i, b) in enumerate(bits):
             state, x[i] = fsm[state, b]
         return x
@@ -84,9 +89,7 @@ class AMI_Signaling(SequenceStateSignalingScheme):
         super().__init__(finite_state_machine=fsm)
 
     def decode(self, y):  # Not optimal!
-        values = [0.0, 1.0]
-        thresholds = [0.5]
-        return unmap(slicer(np.abs(y), thresholds, values), values)
+        return slicer(np.abs(y), [0.5])  # Mark if not zero
 
     def acorr(self, ell):
         if ell == 0:
@@ -106,13 +109,8 @@ class MLT3_Signaling(SequenceStateSignalingScheme):
         super().__init__(finite_state_machine=fsm)
 
     def decode(self, y):  # Not optimal!
-        values = [-1.0, 0.0, 1.0]
-        thresholds = [-0.5, 0.5]
-        bits_hat = np.zeros(np.size(y), dtype=np.int)
-        x_hat = unmap(slicer(y, thresholds, values), values)
-        for i in range(len(x_hat)):
-            bits_hat[i] = (x_hat[i] != x_hat[i - 1])
-        return bits_hat
+        x_hat = slicer(y, [-0.5, 0.5])
+        return (x_hat != np.roll(x_hat, 1, axis=-1)).astype(np.int8)  # Symbols along the last axis
 
 
 collection = collections.OrderedDict([
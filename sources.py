@@ -1,3 +1,5 @@
+import collections
+
 import numpy as np
 
 from PyQt5 import QtCore, QtWidgets
@@ -26,9 +28,12 @@ class Random_BitSource(BitSource):
     def __init__(self, n_bits=500):
         self.n_bits = n_bits
 
+    def generate(self, n_bits):
+        return self.system.rng.randint(0, high=2, size=n_bits)
+
     def process(self):
         self.system.n_bits = self.n_bits  # TODO: Should be in __init__
-        return np.random.randint(0, high=2, size=self.n_bits)
+        return self.generate(self.n_bits)
 
 
 class Random_BitSource_Widget(BitSource_Widget):
@@ -60,6 +65,10 @@ class Fixed_BitSource(BitSource):
         else:
             self.bits = bits
 
+    @property
+    def n_bits(self):
+        return len(self.bits)
+
     def process(self):
         self.system.n_bits = len(self.bits)  # TODO: Should be in __init__
         return self.bits
@@ -85,7 +94,138 @@ class Fixed_BitSource_Widget(BitSource_Widget):
             self.update_signal.emit()
 
 
+# PRBS (pseudo-random binary sequence)
+
+prbs_taps = collections.OrderedDict([  # Polynomials x^n + x^m + 1 (ITU-T O.150)
+    ('PRBS-7', (7, 6)),
+    ('PRBS-15', (15, 14)),
+    ('PRBS-23', (23, 18)),
+    ('PRBS-31', (31, 28)),
+])
+
+
+# Continues the sequence b[i] = b[i - n] ^ b[i - m] from `state` (its last n bits).
+# Since (1 + D^m + D^n)^(2^j) = 1 + D^(m 2^j) + D^(n 2^j) over GF(2), also
+# b[i] = b[i - n 2^j] ^ b[i - m 2^j], so bits are produced m 2^j at a time.
+def prbs(taps, n_bits, state):
+    n, m = taps
+    buf = np.empty(n + n_bits, dtype=np.uint8)
+    buf[:n] = state
+    k = n
+    while k < len(buf):
+        step = 1
+        while 2 * n * step <= k:
+            step *= 2
+        count = min(m * step, len(buf) - k)
+        np.bitwise_xor(buf[k - n*step : k - n*step + count],
+                       buf[k - m*step : k - m*step + count],
+                       out=buf[k : k + count])
+        k += count
+    return buf[n:], buf[len(buf) - n:].copy()
+
+
+# Self-synchronizing: each bit is predicted from the previously received ones.
+# Synchronized after n error-free predictions; a bit error raises three flags.
+class PRBS_Checker:
+    def __init__(self, taps):
+        self.taps = taps
+        self.reset()
+
+    def reset(self):
+        self.history = np.empty(0, dtype=np.uint8)
+        self.synchronized = False
+        self.n_checked = 0
+        self.n_flags = 0
+
+    def process(self, bits):
+        n, m = self.taps
+        r = np.concatenate([self.history, np.asarray(bits, dtype=np.uint8)])
+        self.history = r[max(len(r) - n, 0):]
+        if len(r) <= n:
+            return np.zeros(0, dtype=np.uint8)
+        flags = r[n:] ^ r[n - m : len(r) - m] ^ r[: len(r) - n]
+        start = 0
+        if not self.synchronized:
+            c = np.concatenate([[0], np.cumsum(flags)])
+            idx = np.flatnonzero(c[n:] == c[:-n])
+            if idx.size == 0:
+                return flags
+            self.synchronized = True
+            start = idx[0]
+        self.n_checked += len(flags) - start
+        self.n_flags += int(np.count_nonzero(flags[start:]))
+        return flags
+
+    @property
+    def ber(self):
+        return self.n_flags / (3 * self.n_checked) if self.n_checked else 0.0
+
+
+class PRBS_BitSource(BitSource):
+    def __init__(self, n_bits=500, pattern='PRBS-7', check=False):
+        self.n_bits = n_bits
+        self.pattern = pattern
+        self.check = check
+        self.reset()
+
+    def reset(self):
+        n, _ = prbs_taps[self.pattern]
+        self.state = np.ones(n, dtype=np.uint8)
+        self.checker = PRBS_Checker(prbs_taps[self.pattern]) if self.check else None
+
+    def generate(self, n_bits):
+        bits, self.state = prbs(prbs_taps[self.pattern], n_bits, self.state)
+        return bits
+
+    def process(self):
+        self.system.n_bits = self.n_bits  # TODO: Should be in __init__
+        self.reset()
+        return self.generate(self.n_bits)
+
+
+class PRBS_BitSource_Widget(BitSource_Widget):
+    def initUI(self):
+        layout = QtWidgets.QGridLayout()
+
+        self.combo = QtWidgets.QComboBox()
+        self.combo.addItems(list(prbs_taps.keys()))
+        self.combo.setCurrentIndex(list(prbs_taps.keys()).index(self.source.pattern))
+        self.combo.activated[str].connect(self.onChangePattern)
+
+        self.text_n_bits = QtWidgets.QLineEdit(str(self.source.n_bits))
+        self.text_n_bits.editingFinished.connect(self.onChange)
+
+        self.check_box = QtWidgets.QCheckBox('Check received bits')
+        self.check_box.setChecked(self.source.check)
+        self.check_box.toggled.connect(self.onToggleCheck)
+
+        layout.addWidget(QtWidgets.QLabel('Pattern:'), 0, 0)
+        layout.addWidget(self.combo, 0, 1)
+        layout.addWidget(QtWidgets.QLabel('Number of bits:'), 1, 0)
+        layout.addWidget(self.text_n_bits, 1, 1)
+        layout.addWidget(self.check_box, 2, 0, 1, 2)
+
+        self.setLayout(layout)
+
+    def onChangePattern(self, text):
+        self.source.pattern = text
+        self.update_signal.emit()
+
+    def onChange(self):
+        new_n_bits = int(self.text_n_bits.text())
+        self.text_n_bits.setText(str(new_n_bits))
+
+        if new_n_bits != self.source.n_bits:
+            self.source.n_bits = new_n_bits
+            self.update_signal.emit()
+
+    def onToggleCheck(self, checked):
+        self.source.check = checked
+        self.update_signal.emit()
+
+
 choices = [
-    ('Random bits', Random_BitSource()),
-    ('Fixed bit sequence', Fixed_BitSource())
+    ('Random bits', Random_BitSource),
+    ('Fixed bit sequence', Fixed_BitSource),
+    ('PRBS', PRBS_BitSource),
 ]
@@ -27,6 +27,7 @@ class SystemDiagram(QtWidgets.QGraphicsView):
         self.connections_d = connections_d
 
         self.K = 30
+        self.rect_items = []
 
         self.initUI()
 
@@ -51,6 +52,7 @@ class SystemDiagram(QtWidgets.QGraphicsView):
         rect_item.setToolTip(block.name)
         rect_item.setMousePressEvent(lambda x=idx: self.parent.showBlockOption(x))
         self.scene.addItem(rect_item)
+        self.rect_items.append(rect_item)
 
         text = self.scene.addText(None)
         text.setAcceptHoverEvents(False)
@@ -58,6 +60,26 @@ class SystemDiagram(QtWidgets.QGraphicsView):
         text.setTextWidth(width)
         text.setPos(left, top + 2.5)
 
+    def showProfile(self, records):
+        # Tints each block by its share of the processing time; details go to the tool tip
+        total = sum(r['time'] for r in records if r['kind'] == 'process') or 1.0
+        for (idx, (block, rect_item)) in enumerate(zip(self.blocks_d, self.rect_items)):
+            lines = [block.name]
+            load = 0.0
+            for r in records:
+                if r['index'] == idx:
+                    lines.append('{}: {:.2f} ms, output {:.1f} kB, peak {:.1f} kB'.format(
+                        r['kind'], 1e3 * r['time'], r['size'] / 1024, r['peak_memory'] / 1024))
+                    if r['kind'] == 'process':
+                        load = r['time'] / total
+            rect_item.setLoad(load)
+            rect_item.setToolTip('\n'.join(lines))
+
+    def clearProfile(self):
+        for (block, rect_item) in zip(self.blocks_d, self.rect_items):
+            rect_item.setLoad(0.0)
+            rect_item.setToolTip(block.name)
+
     def addConnection(self, idx, connection):
         path_coords = []
         for coord in connection.path:
@@ -100,6 +122,11 @@ class MyGraphicsRectItem(QtWidgets.QGraphicsRectItem):
     def setMousePressEvent(self, fn):
         self.mousePressEventFn = fn
 
+    def setLoad(self, load):
+        self.leave_brush.setColor(QtGui.QColor(0xFF, int(0xFF * (1.0 - 0.5*load)), int(0xFF * (1.0 - load))))
+        if not self.isUnderMouse():
+            self.setBrush(self.leave_brush)
+
     def mousePressEvent(self, event):
         super().mousePressEvent(event)
         self.mousePressEventFn()
@@ -1,18 +1,58 @@
+import concurrent.futures
+import json
+import os
+import time
+import tracemalloc
+
 import numpy as np
+import scipy.fft
 
 from scipy.signal import welch
 
+from error_statistics import ErrorStatistics
+
 
 class Block:
-    def __init__(self, module, out_type):
+    def __init__(self, module, out_type, role):
         self.module = module
         self.out_type = out_type
-        self.box = module.choices[0][1]
+        self.role = role  # Name the simulator and the windows find the block by, e.g. 'tx_filter'
+        self.boxes = [factory() for (_, factory) in module.choices]  # One instance of each choice per simulator
+        self.box = self.boxes[0]
+
+
+def physical_memory():
+    # Total RAM in bytes, or None where sysconf does not provide it
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class BufferArena:
+    # Output arrays reused across runs of the same size. An array stays valid only until it is handed out
+    # again, so results that must survive the next run have to be copied.
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, key, shape, dtype=np.float64):
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self.buffers[key] = np.empty(shape, dtype)
+        return buffer
+
+    def clear(self):
+        self.buffers.clear()
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in self.buffers.values())
 
 
 class SystemSimulator:
     def __init__(self, blocks):
         self.blocks = blocks
+        self.index = {block.role: i for (i, block) in enumerate(blocks)}
         self.data_t = [None for _ in range(len(blocks))]
         self.data_f = [None for _ in range(len(blocks))]
 
@@ -21,33 +61,427 @@ class SystemSimulator:
         self.update_secondary_properties()
 
         self.seed = 0
+        self.rng = np.random.RandomState(self.seed)  # Bits and noise; reseeded before each run
         self.n_fft = 2**16
+        self.dtype = np.float64  # Waveform precision; np.float32 halves the memory traffic
 
-    def process(self):
-        self._processData()
-        self._processSpectra()
-        self._processAxes()
+        # Threads for the scipy.fft transforms (which split batched transforms, such as the segments of
+        # welch(), across them) and for computing the spectra of the stages concurrently
+        self.workers = 1
 
-    def _processData(self):
-        np.random.seed(self.seed)
+        # Automatic oversampling: the smallest power of two sps in [min_sps, max_sps] such that the pulse has at
+        # most aliasing_tolerance of its energy beyond the Nyquist frequency at the output of every filtering
+        # stage (transmit filter, channel and receive filter). min_sps bounds the timing resolution (1/sps of
+        # a symbol). Turning it off restores the sps set before.
+        self._manual_sps = None
+        self.auto_sps = False
+        self.aliasing_tolerance = 1e-4
+        self.min_sps = 4
+        self.max_sps = 64
+        self._auto_sps = (None, None)
+        self.sampling_instant = 0.0  # Set by the sampler widget
+        self.bathtub = None  # Sampling offset sweep of the last run, if the sampler chose the instant
 
-        for (i, block) in enumerate(self.blocks):
-            if i == 0:
-                self.data_t[0] = self.blocks[0].box.process()  # Process source
+        # Stage outputs kept after a run: 'all', 'requested' (the stages in self.requested) or 'none'
+        # (BER statistics only). Stages not kept are released as soon as the next stage consumed them.
+        self.retention = 'all'
+        self.requested = set()
+
+        # Blocks with an out_shape() write into arrays from this arena instead of allocating new ones.
+        # Off by default: the GUI keeps references to the outputs of the previous run.
+        self.arena = None
+
+        # With a memory budget (in bytes), process() first estimates peak memory and time from a short
+        # calibration run and picks the execution mode: 'full' (as configured), 'reduced' (fewer stages
+        # kept) or 'chunked' (bits streamed through the chain in chunks, BER statistics only). Runs whose
+        # memory_bound() is within the budget skip the calibration.
+        self.memory_budget = None
+        self.calibration_bits = 2048
+        self.live_buffers = 24  # Record-length float64 arrays alive at once, at most (measured: up to 12)
+        self.memory_margin = 1.5  # The calibrated estimates have come out up to 25 % low
+        self.chunk_guard = 16  # Symbols of context on each side of a chunk, besides the pulse length
+        self.plan = None
+        self._calibration = (None, None)
+
+        self.error_stats = ErrorStatistics()
+
+        self.profile = False
+        self.profile_records = []
+        self._profile_origin = time.perf_counter()
+        self._tracing = False
+        self._trace_memory = True
+
+        self._connect()
+
+    def box(self, role):
+        return self.blocks[self.index[role]].box
+
+    def _connect(self):
+        # Boxes are owned by one simulator; the matched filter follows the current transmit filter
+        tx_filter = self.box('tx_filter')
+        for block in self.blocks:
+            for box in block.boxes:
+                box.system = self
+                if hasattr(box, 'tx_filter'):
+                    box.tx_filter = tx_filter
+
+    def select(self, idx_block, idx_choice):
+        block = self.blocks[idx_block]
+        block.box = block.boxes[idx_choice]
+        self._connect()
+
+    def process(self, should_stop=None):
+        # should_stop() is polled between stages; returns False if the run was abandoned
+        self.profile_records = []
+        self._profile_origin = time.perf_counter()
+        if not self.profile and self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        if self.auto_sps:
+            self.sps = self.choose_sps()
+        self.plan = self.make_plan() if self.memory_budget is not None else None
+        if not self._processData(should_stop) or not self._processSpectra(should_stop):
+            return False
+        if any(x is not None for x in self.data_t):  # Axes are only needed to plot the kept stages
+            self._call(None, 'axes', self._processAxes)
+        return True
+
+    def _call(self, idx, kind, fn, *args, **kwargs):
+        if not self.profile:
+            return fn(*args, **kwargs)
+
+        # Wall time, output size and peak memory allocated during the call (None if not traced)
+        if self._trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+            memory_start, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        end = time.perf_counter()
+        if self._trace_memory:
+            _, memory_peak = tracemalloc.get_traced_memory()
+
+        arrays = result if isinstance(result, tuple) else (result,)
+        self.profile_records.append({
+            'index': idx,
+            'block': None if idx is None else self.blocks[idx].box.__class__.__name__,
+            'kind': kind,
+            'start': start - self._profile_origin,
+            'time': end - start,
+            'size': sum(x.nbytes for x in arrays if isinstance(x, np.ndarray)),
+            'peak_memory': memory_peak - memory_start if self._trace_memory else None,
+        })
+        return result
+
+    def dump_profile(self, path):
+        # Chrome trace event format (chrome://tracing, Perfetto)
+        events = []
+        for record in self.profile_records:
+            name = record['kind'] if record['block'] is None else '{}.{}'.format(record['block'], record['kind'])
+            events.append({
+                'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                'ts': 1e6 * record['start'], 'dur': 1e6 * record['time'],
+                'args': {'size': record['size'], 'peak_memory': record['peak_memory']},
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f, indent=1)
+
+    def retained(self, idx, retention=None):
+        if retention is None:
+            retention = self.plan['retention'] if self.plan is not None else self.retention
+        if retention == 'all':
+            return True
+        elif retention == 'requested':
+            return idx in self.requested
+        elif retention == 'none':
+            return False
+        raise ValueError('Unknown retention policy: {}'.format(retention))
+
+    def choose_sps(self):
+        tx, ch, rx = (self.box(role) for role in ('tx_filter', 'channel', 'rx_filter'))
+
+        def params(obj):
+            return (type(obj),) + tuple(sorted((k, v) for (k, v) in vars(obj).items() if isinstance(v, (int, float, str))))
+        key = (tx.pulse.key(), params(ch), type(rx), self.aliasing_tolerance, self.min_sps, self.max_sps)
+        if key == self._auto_sps[0]:
+            return self._auto_sps[1]
+
+        # Pulse at the output of each filtering stage at the highest rate, with room for the channel response
+        # on both sides
+        sps = self.sps
+        self.sps = self.max_sps
+        try:
+            p, delay = tx.taps()
+            N = 2**int(np.ceil(np.log2(len(p) + 2 * self.chunk_guard * self.max_sps)))
+            h_tx = np.zeros(N, self.dtype)
+            h_tx[N//2 - delay : N//2 - delay + len(p)] = p
+            h_ch = ch.process(h_tx)
+            stages = [h_tx, h_ch, rx.process(h_ch)]
+        finally:
+            self.sps = sps
+
+        def required_sps(h):
+            # Energy beyond |f| = B, for B = k * max_sps / N (in units of the symbol rate)
+            E = np.abs(scipy.fft.rfft(h, workers=self.workers))**2
+            E[1:] *= 2
+            if not np.sum(E) > 0.0:
+                return self.min_sps  # Nothing passes
+            outside = 1.0 - np.cumsum(E) / np.sum(E)
+            for candidate in 2**np.arange(int(np.log2(self.min_sps)), int(np.log2(self.max_sps)) + 1):
+                k = int(N * (candidate / 2) / self.max_sps)
+                if outside[min(k, len(outside) - 1)] <= self.aliasing_tolerance:
+                    return int(candidate)
+            return self.max_sps
+
+        value = max(required_sps(h) for h in stages)
+        self._auto_sps = (key, value)
+        return value
+
+    def memory_bound(self, n_bits):
+        # Conservative peak memory [bytes] of a run, without calibrating
+        return self.live_buffers * 8 * max((n_bits + 2) * self.sps, self.n_fft)
+
+    def make_plan(self):
+        # None if the run fits the budget as configured by a wide margin
+        source = self.box('source')
+        n_bits = source.n_bits
+        budget = self.memory_budget
+        if self.memory_bound(n_bits) <= budget:
+            return None
+
+        def plan(mode, retention, chunk_bits=None):
+            records = self._calibrate(min(n_bits, self.calibration_bits))
+            if mode == 'chunked':
+                n_chunks = -(-n_bits // chunk_bits)
+                peak, seconds = self._estimate(records, chunk_bits + 2 * self.guard_symbols(), retention)
+                seconds *= n_chunks
             else:
-                self.data_t[i] = block.box.process(self.data_t[i - 1])
+                n_chunks = 1
+                peak, seconds = self._estimate(records, n_bits, retention)
+            return {'mode': mode, 'retention': retention, 'n_bits': n_bits, 'chunk_bits': chunk_bits,
+                    'n_chunks': n_chunks, 'peak_memory': peak, 'time': seconds, 'budget': budget}
 
-        self.ber = sum(1*(self.data_t[0] != self.data_t[-1])) / self.n_symbols  # TODO: So far, binary only
+        candidates = [plan('full', self.retention)]
+        for retention in ['requested', 'none']:
+            if retention != self.retention and candidates[-1]['retention'] != 'none':
+                candidates.append(plan('reduced', retention))
+        for candidate in candidates:
+            if candidate['peak_memory'] <= budget:
+                return candidate
 
-    def _processSpectra(self):
+        if not hasattr(source, 'generate'):
+            return candidates[-1]  # Over budget, but this source can not be streamed
+        chunk_bits = 2**int(np.log2(max(n_bits, 1)))
+        while True:
+            candidate = plan('chunked', 'none', chunk_bits)
+            if candidate['peak_memory'] <= budget or chunk_bits <= 4 * self.guard_symbols():
+                return candidate
+            chunk_bits //= 2
+
+    def describe_plan(self):
+        plan = self.plan
+        if plan is None:
+            return ''
+        text = '{}: ~{:.3g} MB peak, ~{:.2g} s'.format(plan['mode'], plan['peak_memory'] / 2**20, plan['time'])
+        if plan['mode'] == 'reduced':
+            text += ', BER only' if plan['retention'] == 'none' else ', keeping the requested stages only'
+        elif plan['mode'] == 'chunked':
+            text += ', {} chunks of {} bits'.format(plan['n_chunks'], plan['chunk_bits'])
+        if plan['peak_memory'] > plan['budget']:
+            text += ' (over the {:.3g} MB budget)'.format(plan['budget'] / 2**20)
+        return text
+
+    def guard_symbols(self):
+        pulse = getattr(self.box('tx_filter'), 'pulse', None)
+        return 2 * getattr(pulse, 'filt_len', 1) + self.chunk_guard
+
+    def _calibrate(self, n_bits):
+        # Profiles the chain (except the source) on random bits; the records scale with the run size.
+        # Cached per configuration: parameters such as the SNR do not change the costs.
+        pulse = getattr(self.box('tx_filter'), 'pulse', None)
+        key = (n_bits, self.sps, self.dtype, self.arena is None, pulse.key() if pulse is not None else None,
+               tuple(type(block.box) for block in self.blocks), self.box('encoder').signaling)
+        if key == self._calibration[0]:
+            return self._calibration[1]
+
+        # Memory under tracemalloc, then time in a second run, as tracing slows the stages down many times
+        bits = np.random.RandomState(self.seed).randint(0, 2, size=n_bits)
+        profile, profile_records = self.profile, self.profile_records
+        self.profile, self.profile_records = True, []
+        try:
+            self._processBlocks(bits)
+            stages = self.profile_records
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+            self._trace_memory, self.profile_records = False, []
+            self._processBlocks(bits)
+            for (record, timed) in zip(stages, self.profile_records):
+                record['time'] = timed['time']
+            self._calibration = (key, {'n_bits': n_bits, 'stages': stages})
+            return self._calibration[1]
+        finally:
+            self.profile, self.profile_records = profile, profile_records
+            self._trace_memory = True
+            if not profile and self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+
+    def _estimate(self, records, n_bits, retention):
+        # Peak memory [bytes] and time [s] of a run of n_bits, scaled from the calibration records. Memory
+        # that outlives a stage (such as cached responses) and allocator overhead are left to the margin.
+        Nt = (n_bits + 2) * self.sps
+        itemsize = np.dtype(self.dtype).itemsize
+        scale = {'D': n_bits / records['n_bits'], 'C': Nt / ((records['n_bits'] + 2) * self.sps)}
+
+        kept = 8 * n_bits  # The source bits are needed for the BER
+        live = 0  # Output of the previous stage, if not kept
+        peak = kept
+        seconds = 0.0
+        for record in records['stages']:
+            r = scale[self.blocks[record['index']].out_type]
+            peak = max(peak, kept + live + r * record['peak_memory'])
+            seconds += r * record['time']
+            if self.retained(record['index'], retention):
+                kept += r * record['size']
+                live = 0
+            else:
+                live = r * record['size']
+
+        n_kept = sum(self.retained(i, retention) for (i, b) in enumerate(self.blocks) if b.role != 'source')
+        if n_kept:
+            # welch() works on overlapping segments of float64, about 8 samples of the input per sample
+            n = max(Nt, self.n_fft)
+            n_spectra = sum(self.retained(i, retention) for (i, b) in enumerate(self.blocks) if b.out_type == 'C')
+            peak = max(peak, kept + 8 * itemsize * n) + n_spectra * 8 * self.n_fft
+            seconds += n_spectra * 1e-7 * n
+            peak += 8 * Nt  # Time axis
+        return self.memory_margin * peak, seconds
+
+    def _processBlocks(self, bits):
+        # Runs the stages after the source on the given bits, without keeping any output
+        self.n_bits = len(bits)
+        x = bits
+        for (i, block) in enumerate(self.blocks):
+            if block.role == 'source':
+                continue
+            x = self._call(i, 'process', self._processBlock, block.box, i, x)
+        return x
+
+    def _processChunks(self, should_stop=None):
+        # Bits are streamed through the chain in chunks. Each chunk is extended by guard symbols from its
+        # neighbours, so that the filters see the right context; only the decisions in the middle count.
+        source = self.box('source')
+        n_bits = self.plan['n_bits']
+        chunk_bits = self.plan['chunk_bits']
+        guard = self.guard_symbols()
+
+        if hasattr(source, 'reset'):
+            source.reset()
+        checker = getattr(source, 'checker', None)
+
+        head = np.zeros(0, dtype=int)
+        bits_next = source.generate(min(chunk_bits, n_bits))
+        position = 0
+        while position < n_bits:
+            if should_stop is not None and should_stop():
+                return False
+            bits = bits_next
+            position += len(bits)
+            bits_next = source.generate(min(chunk_bits, n_bits - position))
+            x = np.concatenate((head, bits, bits_next[:guard]))
+            bits_hat = self._processBlocks(x)[len(head) : len(head) + len(bits)]
+            self.error_stats.update(bits, bits_hat)
+            if checker is not None:
+                checker.process(bits_hat)
+            head = np.concatenate((head, bits))[-guard:]
+
+        self.n_bits = self.n_symbols = n_bits
+        return True
+
+    def _processData(self, should_stop=None):
+        self.rng.seed(self.seed)
+
+        # Release the outputs of the previous run before computing the new ones
+        self.data_t = [None for _ in range(len(self.blocks))]
+        self.data_f = [None for _ in range(len(self.blocks))]
+
+        self.error_stats.reset()
+
+        if self.plan is not None and self.plan['mode'] == 'chunked':
+            if not self._processChunks(should_stop):
+                return False
+            checker = getattr(self.box('source'), 'checker', None)
+        else:
+            x = None
+            self.bathtub = None
+            for (i, block) in enumerate(self.blocks):
+                if should_stop is not None and should_stop():
+                    return False
+                if block.role == 'source':
+                    x = bits = self._call(i, 'process', block.box.process)
+                    checker = getattr(block.box, 'checker', None)
+                else:
+                    if block.role == 'sampler' and block.box.auto:
+                        self._call(i, 'select_instant', block.box.select_instant, x, bits, symbols)
+                    x = self._call(i, 'process', self._processBlock, block.box, i, x)
+                if block.role == 'encoder' and self.box('sampler').auto:
+                    symbols = x  # Kept for the sampling offset sweep
+                if self.retained(i):
+                    self.data_t[i] = x
+            bits_hat = x
+
+            self.error_stats.update(bits, bits_hat)
+            if checker is not None:
+                checker.process(bits_hat)
+
+        self.ber = self.error_stats.ber
+        if checker is not None:
+            self.prbs_ber = checker.ber if checker.synchronized else float('nan')
+        else:
+            self.prbs_ber = None
+
+        return True
+
+    def _processBlock(self, box, idx, x):
+        out_shape = getattr(box, 'out_shape', None)
+        if self.arena is None or out_shape is None:
+            return box.process(x)
+        return box.process(x, out=self.arena.get(idx, out_shape(x), self.dtype))
+
+    def _processSpectra(self, should_stop=None):
         fa = self.samp_freq
         Nf = self.n_fft
         Nt = (self.n_symbols + 2) * self.sps
 
-        for (i, block) in enumerate(self.blocks):
-            if block.out_type == 'C':
+        stages = [i for (i, block) in enumerate(self.blocks) if block.out_type == 'C' and self.data_t[i] is not None]
+
+        def spectrum(i, workers):
+            with scipy.fft.set_workers(workers):
                 _, psd = welch(self.data_t[i], fs=fa, nperseg=min(Nf, Nt), return_onesided=False, nfft=Nf)
-                self.data_f[i] = np.fft.fftshift(psd)
+            return np.fft.fftshift(psd)
+
+        if self.workers > 1 and len(stages) > 1 and not self.profile:
+            # The stages are independent, and the transforms release the GIL
+            with concurrent.futures.ThreadPoolExecutor(min(self.workers, len(stages))) as pool:
+                workers = max(self.workers // len(stages), 1)
+                futures = {i: pool.submit(spectrum, i, workers) for i in stages}
+                for (i, future) in futures.items():
+                    if should_stop is not None and should_stop():
+                        for f in futures.values():
+                            f.cancel()
+                        return False
+                    self.data_f[i] = future.result()
+            return True
+
+        for i in stages:
+            if should_stop is not None and should_stop():
+                return False
+            self.data_f[i] = self._call(i, 'spectrum', spectrum, i, self.workers)
+
+        return True
 
     def _processAxes(self):
         fa = self.samp_freq
@@ -56,7 +490,7 @@ class SystemSimulator:
         Nt = (self.n_symbols + 2) * self.sps
 
         self.t = np.arange(Nt) / fa - Ts
-        self.tk = self.t[self.instants]
+        self.tk = self.t[0] + self.instants / fa  # Instants may be fractional sample indices
         self.f = np.arange(-Nf//2, Nf//2) * (fa / Nf)
 
     @property
@@ -68,6 +502,17 @@ class SystemSimulator:
         self._sps = value
         self.update_secondary_properties()
 
+    @property
+    def auto_sps(self):
+        return self._manual_sps is not None
+
+    @auto_sps.setter
+    def auto_sps(self, value):
+        if value and self._manual_sps is None:
+            self._manual_sps = self.sps
+        elif not value and self._manual_sps is not None:
+            self.sps, self._manual_sps = self._manual_sps, None
+
     @property
     def bit_rate(self):
         return self._bit_rate
@@ -77,6 +522,10 @@ class SystemSimulator:
         self._bit_rate = value
         self.update_secondary_properties()
 
+    @property
+    def complex_dtype(self):
+        return np.result_type(self.dtype, np.complex64)
+
     def update_secondary_properties(self):
         self.symbol_rate = self.bit_rate * 1  # TODO: So far, binary only...
         self.samp_freq = self.sps * self.symbol_rate
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+import channels_frequency
+
+from benchmark import build_system
+
+
+@pytest.mark.parametrize('pulse', ['Rectangular NRZ', 'Raised-cosine'])
+@pytest.mark.parametrize('channel', range(len(channels_frequency.choices)))
+def test_float32_ber_matches_float64(pulse, channel):
+    # Same bits and noise in both precisions; the BERs agree within three standard deviations
+    n_bits = 20000
+    for snr_db in [0, 4, 8]:
+        ber = []
+        for dtype in [np.float64, np.float32]:
+            system = build_system(sps=8, n_bits=n_bits, pulse=pulse, channel=channel, dtype=dtype)
+            system.retention = 'none'
+            system.box('noise').snr_db = snr_db
+            system.process()
+            ber.append(system.ber)
+        assert ber[0] > 0.0
+        assert abs(ber[1] - ber[0]) <= 3 * np.sqrt(ber[0] * (1 - ber[0]) / n_bits) + 1 / n_bits
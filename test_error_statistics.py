@@ -0,0 +1,38 @@
+import numpy as np
+
+from error_statistics import ErrorStatistics
+
+
+def _feed(e, cuts):
+    stats = ErrorStatistics()
+    bits = np.zeros(len(e), dtype=np.int64)
+    for (a, b) in zip(cuts[:-1], cuts[1:]):
+        stats.update(bits[a:b], e[a:b])
+    return stats
+
+
+def test_bursts_independent_of_chunking():
+    rng = np.random.RandomState(0)
+    e = np.zeros(200, dtype=np.int64)
+    e[3:7] = 1
+    e[40:41] = 1
+    e[100:160] = rng.randint(0, 2, size=60)
+    e[190:] = 1
+    expected = _feed(e, [0, len(e)]).burst_histogram
+    assert expected[4] >= 1
+    chunkings = [[0, 4, 5, 10, len(e)], [0, 4, 6, 10, len(e)], list(range(0, len(e) + 1)),
+                 [0, 3, 7, 41, 195, len(e)]]
+    chunkings += [[0] + sorted(rng.choice(np.arange(1, len(e)), size=k, replace=False)) + [len(e)]
+                  for k in (5, 20, 80)]
+    for cuts in chunkings:
+        stats = _feed(e, cuts)
+        np.testing.assert_array_equal(stats.burst_histogram, expected)
+        assert stats.n_errors == np.count_nonzero(e)
+        np.testing.assert_array_equal(stats.positions, np.flatnonzero(e))
+
+
+def test_burst_spanning_chunks():
+    e = np.zeros(10, dtype=np.int64)
+    e[3:7] = 1
+    for cuts in ([0, 4, 5, 10], [0, 4, 6, 10]):
+        np.testing.assert_array_equal(_feed(e, cuts).burst_histogram, [0, 0, 0, 0, 1])
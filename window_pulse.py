@@ -1,4 +1,4 @@
-from PyQt5 import QtGui, QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets
 
 import matplotlib
 matplotlib.use("Qt5Agg")
@@ -8,21 +8,59 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 
+import collections
+import threading
+
 import numpy as np
+import scipy.fft
 
 import pulses, filter_rx
+from channels_frequency import fold
+
+
+def _embed(taps, delay, N):
+    # Places taps[delay] at the center of a length-N response
+    h = np.zeros(N)
+    start = N//2 - delay
+    i0, i1 = max(start, 0), min(start + len(taps), N)
+    h[i0:i1] = taps[i0 - start : i1 - start]
+    return h
+
+
+def _magnitude_response(h, n_fft, workers=1):
+    # |H(f)| for f = -n_fft/2, ..., n_fft/2 - 1 (times sps / n_fft), from the real FFT along the last axis.
+    # Responses longer than n_fft are folded, which samples their spectrum instead of truncating them.
+    if h.shape[-1] > n_fft:
+        h = np.stack([fold(x, n_fft) for x in h])
+    H = np.abs(scipy.fft.rfft(h, n_fft, workers=workers))
+    return np.concatenate((H[..., n_fft//2 : 0 : -1], H[..., : n_fft//2]), axis=-1)
+
+
+# Everything plot() needs, published at once by compute()
+Responses = collections.namedtuple('Responses', ['key', 'tx', 'ch', 'rx', 't', 'f', 'h_tx', 'h_ch', 'h_rx', 'h_ep',
+                                                 'H_tx', 'H_ch', 'H_rx', 'H_ep', 'truncation', 'isi'])
 
 
 class WindowPulse(QtWidgets.QMainWindow):
+    drawn = QtCore.pyqtSignal()  # Emitted once the canvas is up to date
+    f_points = 1024  # Frequency samples across the narrowest plotted band
+
     def __init__(self, parent, system):
         super().__init__(parent)
 
         self.parent = parent
         self.system = system
         self.selected = 'TX pulse'
+        self.show_isi = False  # Worst-case ISI annotation of the effective pulse
+
+        # Computed only while visible, and only when the relevant parameters change. compute() runs on the
+        # compute thread, and on the GUI thread when the window is shown.
+        self.visible = False
+        self.responses = None
+        self.replot = False
+        self.lock = threading.Lock()
 
         self.initUI()
-        self.plot()
 
     def initUI(self):
         self.setWindowTitle('NyqLab: Pulse')
@@ -40,6 +78,9 @@ class WindowPulse(QtWidgets.QMainWindow):
         self.combo.addItem('Effective pulse')
         self.combo.activated[int].connect(self.onComboActivated)
 
+        self.isi_check = QtWidgets.QCheckBox('Worst-case eye')
+        self.isi_check.toggled.connect(self.onIsiToggled)
+
         # Axis
         self.ax_t = self.figure.add_subplot(1, 2, 1)
         self.ax_f = self.figure.add_subplot(1, 2, 2)
@@ -47,6 +88,7 @@ class WindowPulse(QtWidgets.QMainWindow):
         layout = QtWidgets.QHBoxLayout()
         layout.addWidget(toolbar)
         layout.addWidget(self.combo)
+        layout.addWidget(self.isi_check)
         widget_top = QtWidgets.QWidget()
         widget_top.setLayout(layout)
 
@@ -59,39 +101,80 @@ class WindowPulse(QtWidgets.QMainWindow):
         widget.setLayout(layout)
         self.resize(600, 400)
 
+    def _key(self):
+        def params(obj):
+            return (type(obj),) + tuple(sorted((k, v) for (k, v) in vars(obj).items() if isinstance(v, (int, float, str))))
+        tx, ch, rx = (self.system.box(role) for role in ('tx_filter', 'channel', 'rx_filter'))
+        return (self.system.sps, params(tx), tx.pulse.key(), params(ch), params(rx),
+                tuple(self.system.box('encoder').signaling.levels))
+
     def compute(self):
-        sps = self.system.sps
-        Ns = 256
-        N = (Ns + 2) * sps
-
-        # Blocks  -- TODO: Refactor
-        self.tx = self.system.blocks[2].box
-        self.ch = self.system.blocks[3].box
-        self.rx = self.system.blocks[5].box
-
-        # Axes
-        self.t = np.arange(-N//2, N//2) / sps
-        self.f = np.arange(-N//2, N//2) * (sps / N)
-
-        # Impulse responses
-        impulse_d = np.zeros(Ns); impulse_d[Ns//2] = 1
-        impulse_c = np.zeros(N); impulse_c[N//2] = sps
-
-        self.h_tx = self.tx.process(impulse_d)
-        self.h_ch = self.ch.process(impulse_c)
-        self.h_rx = self.rx.process(impulse_c)
-        if not isinstance(self.rx, filter_rx.Bypass_ReceiveFilter):
-            self.h_rx /= np.sum(self.h_rx**2) / self.system.sps
-        self.h_ep = self.rx.process(self.ch.process(self.h_tx))
-
-        # Frequency responses
-        self.H_tx = np.fft.fftshift(np.fft.fft(self.h_tx)) / sps
-        self.H_ch = np.fft.fftshift(np.fft.fft(self.h_ch)) / sps
-        self.H_rx = np.fft.fftshift(np.fft.fft(self.h_rx)) / sps
-        self.H_ep = np.fft.fftshift(np.fft.fft(self.h_ep)) / sps
+        if not self.visible:
+            return
+        with self.lock:
+            key = self._key()
+            if self.responses is not None and key == self.responses.key:
+                return
+
+            sps = self.system.sps
+            Ns = 256
+            N = (Ns + 2) * sps
+
+            tx = self.system.box('tx_filter')
+            ch = self.system.box('channel')
+            rx = self.system.box('rx_filter')
+
+            # Frequency grid: f_points samples across the narrowest band that is plotted
+            f_lims = [tx.pulse.ax_f_lim, ch.ax_f_lim, self._rx_lims(tx, rx)[1]]
+            band = min(f_lim[1] - f_lim[0] for f_lim in f_lims)
+            n_fft = 2**int(np.ceil(np.log2(self.f_points * sps / band)))
+
+            # Axes
+            t = np.arange(-N//2, N//2) / sps
+            f = np.arange(-n_fft//2, n_fft//2) * (sps / n_fft)
+
+            # Impulse responses
+            impulse_c = np.zeros(N); impulse_c[N//2] = sps
+
+            h_tx = _embed(*tx.taps(), N)
+            truncation = None
+            if isinstance(tx.pulse, pulses.LongPulse) and (tx.pulse.energy_fraction < 1.0 or tx.pulse.window):
+                truncation = pulses.truncation_report(tx.pulse, sps)
+            h_ch = ch.process(impulse_c)
+            if hasattr(rx, 'taps'):
+                h_rx = _embed(*rx.taps(), N)
+                h_rx /= np.sum(h_rx**2) / sps
+            else:
+                h_rx = rx.process(impulse_c)
+            h_ep = rx.process(ch.process(h_tx))
+            isi = pulses.worst_case_eye(h_ep, sps, N//2, self.system.box('encoder').signaling.levels)
+
+            # Frequency responses (magnitude only), as one batch of transforms
+            H = _magnitude_response(np.stack((h_tx, h_ch, h_rx, h_ep)), n_fft, self.system.workers) / sps
+
+            self.responses = Responses(key, tx, ch, rx, t, f, h_tx, h_ch, h_rx, h_ep, *H, truncation, isi)
+            self.replot = True
+
+    def refresh(self):
+        with self.lock:
+            replot, self.replot = self.replot, False
+        if replot:
+            self.plot()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.visible = True
+        self.compute()
+        self.refresh()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.visible = False
 
     def plot(self):
-        self.compute()
+        r = self.responses
+        if r is None:
+            return
 
         self.ax_t.cla()
         self.ax_t.grid(True, which='major', linestyle='--')
@@ -102,62 +185,79 @@ class WindowPulse(QtWidgets.QMainWindow):
         self.ax_f.set_xlabel('$f / R_\mathrm{s}$')
 
         if self.selected == 'TX pulse':
-            self._plot_tx()
+            self._plot_tx(r)
         elif self.selected == 'Channel response':
-            self._plot_ch()
+            self._plot_ch(r)
         elif self.selected == 'RX pulse':
-            self._plot_rx()
+            self._plot_rx(r)
         elif self.selected == 'Effective pulse':
-            self._plot_ep()
+            self._plot_ep(r)
 
         self.figure.subplots_adjust(left=0.10, right=0.95, top=0.94, bottom=0.15, wspace=0.40)
         self.canvas.draw()
+        self.drawn.emit()
+
+    def _plot_tx(self, r):
+        self.ax_t.plot(r.t, r.h_tx, 'k-', linewidth=2)
+        self.ax_t.axis(r.tx.pulse.ax_t_lim)
+        if r.truncation is not None:
+            self.ax_t.set_title('{span:.3g} Ts: ISI error {isi_error_db:.1f} dB, PSD error {psd_error_db:.1f} dB'.format(
+                **r.truncation), fontsize='small')
 
-    def _plot_tx(self):
-        self.ax_t.plot(self.t, self.h_tx, 'k-', linewidth=2)
-        self.ax_t.axis(self.tx.pulse.ax_t_lim)
+        self.ax_f.plot(r.f, abs(r.H_tx), 'k-', linewidth=2)
+        self.ax_f.axis(r.tx.pulse.ax_f_lim)
 
-        self.ax_f.plot(self.f, abs(self.H_tx), 'k-', linewidth=2)
-        self.ax_f.axis(self.tx.pulse.ax_f_lim)
+    def _plot_ch(self, r):
+        self.ax_t.plot(r.t, r.h_ch, 'k-', linewidth=2)
+        self.ax_t.axis(r.ch.ax_t_lim)
 
-    def _plot_ch(self):
-        self.ax_t.plot(self.t, self.h_ch, 'k-', linewidth=2)
-        self.ax_t.axis(self.ch.ax_t_lim)
+        self.ax_f.plot(r.f, abs(r.H_ch), 'k-', linewidth=2)
+        self.ax_f.axis(r.ch.ax_f_lim)
 
-        self.ax_f.plot(self.f, abs(self.H_ch), 'k-', linewidth=2)
-        self.ax_f.axis(self.ch.ax_f_lim)
+    @staticmethod
+    def _rx_lims(tx, rx):
+        if isinstance(rx, filter_rx.Bypass_ReceiveFilter):
+            return [-2.0, 2.0, -2.0, 6.0], [-6.0, 6.0, -0.25, 1.25]
+        return np.array(tx.pulse.ax_t_lim), np.array(tx.pulse.ax_f_lim)
 
-    def _plot_rx(self):
+    def _plot_rx(self, r):
         delay = 0.0
-        if isinstance(self.rx, filter_rx.Bypass_ReceiveFilter):
-            t_lim = [-2.0, 2.0, -2.0, 6.0]
-            f_lim = [-6.0, 6.0, -0.25, 1.25]
-        else:
-            t_lim = np.array(self.tx.pulse.ax_t_lim)
-            f_lim = np.array(self.tx.pulse.ax_f_lim)
-            if isinstance(self.tx.pulse, pulses.ShortPulse):
-                delay += 1.0
-
-        self.ax_t.plot(self.t + delay, self.h_rx, 'k-', linewidth=2)
+        t_lim, f_lim = self._rx_lims(r.tx, r.rx)
+        if not isinstance(r.rx, filter_rx.Bypass_ReceiveFilter) and isinstance(r.tx.pulse, pulses.ShortPulse):
+            delay += 1.0
+
+        self.ax_t.plot(r.t + delay, r.h_rx, 'k-', linewidth=2)
         self.ax_t.axis(t_lim)
 
-        self.ax_f.plot(self.f, abs(self.H_rx), 'k-', linewidth=2)
+        self.ax_f.plot(r.f, abs(r.H_rx), 'k-', linewidth=2)
         self.ax_f.axis(f_lim)
 
-    def _plot_ep(self):
+    def _plot_ep(self, r):
         delay = 0.0
-        t_lim = np.array(self.tx.pulse.ax_t_lim)
-        f_lim = np.array(self.tx.pulse.ax_f_lim)
-        if not isinstance(self.rx, filter_rx.Bypass_ReceiveFilter) and isinstance(self.tx.pulse, pulses.ShortPulse):
+        t_lim = np.array(r.tx.pulse.ax_t_lim)
+        f_lim = np.array(r.tx.pulse.ax_f_lim)
+        if not isinstance(r.rx, filter_rx.Bypass_ReceiveFilter) and isinstance(r.tx.pulse, pulses.ShortPulse):
             t_lim[0:2] += [-0.5, 1.5]
             delay += 1.0
 
-        self.ax_t.plot(self.t + delay, self.h_ep, 'k-', linewidth=2)
+        self.ax_t.plot(r.t + delay, r.h_ep, 'k-', linewidth=2)
         self.ax_t.axis(t_lim)
-
-        self.ax_f.plot(self.f, abs(self.H_ep), 'k-', linewidth=2)
+        if self.show_isi:
+            isi = r.isi
+            t_k = isi['cursor_index'] + isi['best'] + delay
+            self.ax_t.vlines(t_k, 0.0, isi['cursors'], colors='r')
+            self.ax_t.plot(t_k, isi['cursors'], 'ro', markersize=4)
+            best = np.searchsorted(isi['offsets'], isi['best'])
+            self.ax_t.set_title('Eye {:.3g}, distortion {:.3g} at {:+.1f}% Ts'.format(
+                isi['eye_opening'][best], isi['peak_distortion'][best], 100 * isi['best']), fontsize='small')
+
+        self.ax_f.plot(r.f, abs(r.H_ep), 'k-', linewidth=2)
         self.ax_f.axis(f_lim)
 
+    def onIsiToggled(self, checked):
+        self.show_isi = checked
+        self.plot()
+
     def onComboActivated(self, idx):
         self.selected = self.combo.currentText()
         self.plot()
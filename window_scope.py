@@ -1,4 +1,4 @@
-from PyQt5 import QtGui, QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets
 
 import matplotlib
 matplotlib.use("Qt5Agg")
@@ -6,19 +6,69 @@ matplotlib.use("Qt5Agg")
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
+from matplotlib.collections import LineCollection
+
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 
 import numpy as np
 
+from scipy.signal import resample_poly
+
+
+def eye_traces(x, sps, n_traces):
+    # Trace i spans [i*sps - sps//2, (i+2)*sps + sps//2), for i = 1, 2, ..., n_traces
+    x = x[sps - sps//2:]
+    return np.lib.stride_tricks.as_strided(x, shape=(n_traces, 3*sps), strides=(sps*x.strides[0], x.strides[0]),
+                                           writeable=False)
+
+
+def eye_density(traces, y_lim, n_bins, chunk=4096):
+    # 2-D histogram with one column per sample of the trace and n_bins rows over y_lim
+    y_min, y_max = y_lim
+    scale = n_bins / (y_max - y_min)
+    n_cols = traces.shape[1]
+    cols = np.arange(n_cols)
+    counts = np.zeros(n_bins * n_cols + 1, dtype=np.int64)  # Last entry collects the samples out of range
+    for i in range(0, len(traces), chunk):
+        rows = np.floor((traces[i : i+chunk] - y_min) * scale).astype(np.int64)
+        idx = rows * n_cols + cols
+        idx[(rows < 0) | (rows >= n_bins)] = n_bins * n_cols
+        counts += np.bincount(idx.ravel(), minlength=len(counts))
+    return counts[:-1].reshape(n_bins, n_cols)
+
+
+def minmax_decimate(x, y, x_lim, n_columns):
+    # Keeps the samples within x_lim (x increasing) and, if there are more than two per pixel column,
+    # only the minimum and maximum of each column, in their original order
+    i0 = max(np.searchsorted(x, x_lim[0], side='right') - 1, 0)
+    i1 = min(np.searchsorted(x, x_lim[1], side='left') + 1, len(x))
+    x, y = x[i0:i1], y[i0:i1]
+    n = len(x)
+    if n <= 2 * n_columns:
+        return x, y
+    bucket = -(-n // n_columns)
+    n_full = n // bucket
+    y_b = y[: n_full * bucket].reshape(n_full, bucket)
+    base = np.arange(n_full) * bucket
+    idx = np.sort(np.column_stack((base + np.argmin(y_b, axis=1), base + np.argmax(y_b, axis=1))), axis=1).ravel()
+    if n > n_full * bucket:
+        tail = y[n_full * bucket:]
+        idx = np.concatenate((idx, np.sort([n_full * bucket + np.argmin(tail), n_full * bucket + np.argmax(tail)])))
+    return x[idx], y[idx]
+
 
 class WindowScope(QtWidgets.QMainWindow):
+    drawn = QtCore.pyqtSignal()  # Emitted once the canvas is up to date
+
     def __init__(self, parent, system):
         super().__init__(parent)
 
         self.parent = parent
         self.system = system
         self.show_eye_diagram = False
+        self.eye_max_lines = 200  # Above this, the eye diagram is drawn as a density image
+        self.display_sps = None  # If set, signals simulated at fewer samples per symbol are interpolated for display
 
         self.ax_t_lim_free = [-1.0, 21.0, -1.5, 1.5]
         self.ax_t_lim_eyed = [-0.1, 1.1, -1.5, 1.5]
@@ -40,12 +90,18 @@ class WindowScope(QtWidgets.QMainWindow):
         action_eye.triggered.connect(self.onEyeClick)
         toolbar.addAction(action_eye)
 
+        # Display upsampling toolbar button
+        action_upsample = QtWidgets.QAction(QtGui.QIcon.fromTheme('zoom-in'), 'Upsample for display', self)
+        action_upsample.setCheckable(True)
+        action_upsample.triggered.connect(self.onUpsampleClick)
+        toolbar.addAction(action_upsample)
+
         # Axis
         self.ax_t = self.figure.add_subplot(2, 1, 1)
         self.ax_t.grid(True, which='major', linestyle='--')
         self.ax_t.set_xlabel('$t / T_\mathrm{b}$')
         self.ax_t.axis(self.ax_t_lim_free)
-        self.ax_t.xaxis.set_major_locator(ticker.MultipleLocator(1.0))
+        self.ax_t.xaxis.set_major_locator(ticker.MaxNLocator(nbins=25, steps=[1, 2, 5, 10], integer=True))
         self.ax_t.yaxis.set_major_locator(ticker.MultipleLocator(0.5))
 
         self.ax_f = self.figure.add_subplot(2, 1, 2)
@@ -55,6 +111,39 @@ class WindowScope(QtWidgets.QMainWindow):
         self.ax_f.xaxis.set_major_locator(ticker.MultipleLocator(0.5))
         self.ax_f.yaxis.set_major_locator(ticker.MultipleLocator(10.0))
 
+        # Persistent artists, updated in place by plot() and drawn by blitting
+        self.zero_t = self.ax_t.axhline(0.0, color='k')
+        self.eye_h = self.ax_t.axhline(0.0, color='k', linewidth=3, visible=False)
+        self.eye_v = self.ax_t.axvline(0.5, color='k', linewidth=3, visible=False)
+        self.ax_f.axhline(0.0, color='k')
+
+        self.artists = []
+        self.data = []  # Full resolution (x, y) of each artist, decimated on display
+        self.colors = []
+        for (block, connection) in zip(self.system.blocks, self.parent.system_diagram.connections_d):
+            color = tuple(x / 255 for x in connection.color)
+            self.colors.append(color)
+            artists = {}
+            if block.out_type == 'C':
+                artists['line'], = self.ax_t.plot([], [], color=color, linewidth=2)
+                artists['eye_lines'] = self.ax_t.add_collection(LineCollection([], colors=[color], linewidths=2))
+                artists['eye_image'] = self.ax_t.imshow(np.zeros((1, 1, 4)), origin='lower', aspect='auto',
+                                                        interpolation='nearest')
+                artists['spectrum'], = self.ax_f.plot([], [], color=color, linewidth=2)
+            elif block.out_type == 'D':
+                artists['step'], = self.ax_t.plot([], [], color=color, linewidth=1, drawstyle='steps-pre')
+                artists['dots'] = self.ax_t.scatter([], [], color=color, linewidth=1)
+            for artist in artists.values():
+                artist.set_animated(True)
+            self.artists.append(artists)
+            self.data.append({})
+        self.ax_t.axis(self.ax_t_lim_free)
+        self.ax_t.callbacks.connect('xlim_changed', self._decimate)
+        self.ax_f.callbacks.connect('xlim_changed', self._decimate)
+
+        self.backgrounds = None
+        self.canvas.mpl_connect('draw_event', self.onDraw)
+        self.canvas.mpl_connect('resize_event', self.onResize)
 
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(toolbar)
@@ -64,67 +153,141 @@ class WindowScope(QtWidgets.QMainWindow):
         self.setCentralWidget(widget)
         widget.setLayout(layout)
         self.resize(800, 500)
+        self.figure.tight_layout()
 
     def plot(self):
         Ns = self.system.n_symbols
         sps = self.system.sps
         s_inst = self.system.sampling_instant
 
+        # Stages not kept by the simulator (see SystemSimulator.retention) are left empty
+        for (data_t, artists, data) in zip(self.system.data_t, self.artists, self.data):
+            if data_t is None:
+                self._clear(artists, data)
+
+        # Continuous signals are interpolated for display when simulated with few samples per symbol
+        up = max(self.display_sps // sps, 1) if self.display_sps else 1
+        display = lambda x: resample_poly(x, up, 1) if up > 1 else x
+
         # Time domain
-        for line in self.ax_t.lines:
-            line.remove()
-        for collection in self.ax_t.collections:
-            collection.remove()
-        self.plots_t = []
         if not self.show_eye_diagram:
-            self.ax_t.axhline(0.0, color='k')
             t = self.system.t
-            # TODO: Should not need system diagram.
-            for (data_t, block, connection) in zip(self.system.data_t, self.system.blocks, self.parent.system_diagram.connections_d):
-                color = tuple(x / 255 for x in connection.color)
-                if block.out_type == 'C':
-                    lines_t = [self.ax_t.plot(t, data_t, color=color, linewidth=2)]
-                elif block.out_type == 'D':
+            t_up = t[0] + np.arange(len(t) * up) / (self.system.samp_freq * up)
+            for (i, (data_t, artists, data)) in enumerate(zip(self.system.data_t, self.artists, self.data)):
+                if data_t is None:
+                    continue
+                elif 'line' in artists:
+                    data['line'] = (t_up, display(data_t))
+                elif 'step' in artists:
+                    if self.system.blocks[i].role == 'encoder':  # Symbol indices
+                        data_t = self.system.levels[data_t]
                     x = np.repeat(self.system.tk, 2)
                     y = np.dstack((np.zeros(data_t.shape[0]), data_t)).flatten()
-                    lines_t = [self.ax_t.step(x, y, color=color, linewidth=1),
-                               self.ax_t.scatter(x[1::2], y[1::2], color=color, linewidth=1)]
-                self.plots_t.append(lines_t)
+                    data['step'] = (x, y)
+                    data['dots'] = (x[1::2], y[1::2])
         else:
-            self.ax_t.axhline(0.0, color='k', linewidth=3)
-            self.ax_t.axvline(0.5, color='k', linewidth=3)
-            t = np.arange(-sps, 2*sps) / sps - s_inst
-            for (data_t, block, connection) in zip(self.system.data_t, self.system.blocks, self.parent.system_diagram.connections_d):
-                color = tuple(x / 255 for x in connection.color)
-                if block.out_type == 'C':
-                    lines_t = [self.ax_t.plot(t, data_t[i*sps - sps//2: (i+2)*sps + sps//2], color=color, linewidth=2)
-                               for i in range(1, min(Ns, 100))]
-                elif block.out_type == 'D':
-                    # TODO: Implement me.
-                    lines_t = []
-                self.plots_t.append(lines_t)
+            sps_d = sps * up
+            t = np.arange(-sps_d, 2*sps_d) / sps_d - s_inst
+            for (data_t, artists, color) in zip(self.system.data_t, self.artists, self.colors):
+                if data_t is None:
+                    continue
+                elif 'line' in artists:
+                    traces = eye_traces(display(data_t), sps_d, Ns - 1)
+                    if len(traces) <= self.eye_max_lines:
+                        segments = np.empty(traces.shape + (2,))
+                        segments[:, :, 0] = t
+                        segments[:, :, 1] = traces
+                        artists['eye_lines'].set_segments(segments)
+                        artists['eye_image'].set_data(np.zeros((1, 1, 4)))
+                    else:
+                        y_min, y_max = self.ax_t.get_ylim()
+                        counts = eye_density(traces, (y_min, y_max), max(int(self.ax_t.bbox.height) // 2, 1))
+                        image = np.zeros(counts.shape + (4,))
+                        image[:, :, :3] = color
+                        image[:, :, 3] = np.sqrt(counts / max(np.max(counts), 1))
+                        artists['eye_lines'].set_segments([])
+                        artists['eye_image'].set_data(image)
+                        artists['eye_image'].set_extent((t[0] - 0.5/sps_d, t[-1] + 0.5/sps_d, y_min, y_max))
+                # TODO: Eye diagram of discrete signals.
 
         # Frequency domain
-        for line in self.ax_f.lines:
-            line.remove()
-        self.plots_f = []
-        self.ax_f.axhline(0.0, color='k')
         f = self.system.f
-        for (data_f, block, connection) in zip(self.system.data_f, self.system.blocks, self.parent.system_diagram.connections_d):
-            color = tuple(x / 255 for x in connection.color)
-            if block.out_type == 'C':
-                lines_f = [self.ax_f.plot(f, 10.0*np.log10(data_f), color=color, linewidth=2)]
+        for (data_f, artists, data) in zip(self.system.data_f, self.artists, self.data):
+            if 'spectrum' in artists and data_f is not None:
+                data['spectrum'] = (f, 10.0*np.log10(data_f))
+
+        self.update_visible([self.ax_t, self.ax_f])
+
+    def _clear(self, artists, data):
+        data.clear()
+        for (key, artist) in artists.items():
+            if key == 'dots':
+                artist.set_offsets(np.zeros((0, 2)))
+            elif key == 'eye_lines':
+                artist.set_segments([])
+            elif key == 'eye_image':
+                artist.set_data(np.zeros((1, 1, 4)))
             else:
-                lines_f = []
-            self.plots_f.append(lines_f)
+                artist.set_data([], [])
 
-        self.update_visible()
+    def update_visible(self, axes=()):
+        # Redraws the given axes, and those where a trace was shown or hidden
+        axes = set(axes)
+        eye = self.show_eye_diagram
+        self.zero_t.set_visible(not eye)
+        self.eye_h.set_visible(eye)
+        self.eye_v.set_visible(eye)
+        for (artists, connection) in zip(self.artists, self.parent.system_diagram.connections_d):
+            for (key, artist) in artists.items():
+                visible = connection.visible and (key == 'spectrum' or key.startswith('eye_') == eye)
+                if artist.get_visible() != visible:
+                    artist.set_visible(visible)
+                    axes.add(artist.axes)
+        axes = [ax for ax in [self.ax_t, self.ax_f] if ax in axes]
+        for ax in axes:
+            self._decimate(ax)
+        self._blit(axes)
 
-    def update_visible(self):
-        for (lines_t, lines_f, connection) in zip(self.plots_t, self.plots_f, self.parent.system_diagram.connections_d):
-            plt.setp(lines_t + lines_f, visible=connection.visible)
-        self.canvas.draw()
-        plt.tight_layout()
+    def _decimate(self, ax):
+        # Reduces the visible traces of the axes to about two points per pixel column
+        n_columns = max(int(ax.bbox.width), 1)
+        x_lim = sorted(ax.get_xlim())
+        for (artists, data) in zip(self.artists, self.data):
+            for (key, (x, y)) in data.items():
+                artist = artists[key]
+                if artist.axes is ax and artist.get_visible():
+                    x_d, y_d = minmax_decimate(x, y, x_lim, n_columns)
+                    if key == 'dots':
+                        artist.set_offsets(np.column_stack((x_d, y_d)))
+                    else:
+                        artist.set_data(x_d, y_d)
+
+    def _blit(self, axes):
+        if self.backgrounds is None:
+            self.canvas.draw()  # Full redraw; onDraw captures the backgrounds
+        else:
+            for ax in axes:
+                self.canvas.restore_region(self.backgrounds[ax])
+                self._drawArtists(ax)
+                self.canvas.blit(ax.bbox)
+        self.drawn.emit()
+
+    def _drawArtists(self, ax):
+        for artists in self.artists:
+            for artist in artists.values():
+                if artist.axes is ax and artist.get_visible():
+                    ax.draw_artist(artist)
+
+    def onDraw(self, event):
+        self.backgrounds = {ax: self.canvas.copy_from_bbox(ax.bbox) for ax in [self.ax_t, self.ax_f]}
+        for ax in [self.ax_t, self.ax_f]:
+            self._drawArtists(ax)
+
+    def onResize(self, event):
+        self.figure.tight_layout()
+        self.backgrounds = None
+        self._decimate(self.ax_t)
+        self._decimate(self.ax_f)
 
     def onEyeClick(self, idx):
         self.show_eye_diagram ^= True
@@ -134,4 +297,13 @@ class WindowScope(QtWidgets.QMainWindow):
         else:
             self.ax_t_lim_free = self.ax_t.axis()
             self.ax_t.axis(self.ax_t_lim_eyed)
-        self.plot()
+        self.backgrounds = None  # Axes changed; the next update redraws everything
+        if self.parent.isComputing():
+            self.update_visible()  # Data is replotted when the simulation finishes
+        else:
+            self.plot()
+
+    def onUpsampleClick(self, checked):
+        self.display_sps = 64 if checked else None
+        if not self.parent.isComputing():
+            self.plot()